@@ -0,0 +1,315 @@
+'''
+Fill an SQLite file with a synthetic gratia database, so that
+GetOverflowjobsInfo7.py can be run and its query strategies measured
+without access to rcf-gratia.unl.edu:
+
+    python GenerateSyntheticGratia.py --jobs 1000000 --days 7 gratia.sqlite
+    python GetOverflowjobsInfo7.py --sqlite gratia.sqlite --benchmark perquery,singlescan,grouped
+
+Only the tables and columns the report reads are created
+(JobUsageRecord, JobUsageRecord_Meta, Resource, Probe and Site), with
+the indexes gratia has on them.  The pilot records look like the ones of
+the glidein factory: a few percent of the jobs run on overflow slots
+(HostDescription "<site>-overflow"), most exit with 0, a fraction of a
+percent with 84 (file open failure) and the others with a few usual
+codes; wall times are roughly exponential, cpu efficiencies mostly
+above 50%.  Every job has its ExitCode and two other Resource rows, as
+in gratia where Resource is the largest table.
+The end times are spread over the --days days before --end (default:
+now), so the report window of today is covered.  With --xrootd-log, an
+xrootd log for these jobs is written too (see WriteXrootdLog), e.g. to
+measure the log parser:
+
+    python GetOverflowjobsInfo7.py --parse-benchmark xrootd.log
+'''
+
+import os
+import sys
+import time
+import calendar
+import random
+import sqlite3
+from datetime import datetime, timedelta
+from optparse import OptionParser
+
+GratiaSchema = """
+CREATE TABLE JobUsageRecord (
+    dbid INTEGER PRIMARY KEY,
+    LocalJobId TEXT,
+    CommonName TEXT,
+    Host TEXT,
+    StartTime TIMESTAMP,
+    EndTime TIMESTAMP,
+    WallDuration DOUBLE,
+    CpuUserDuration DOUBLE,
+    CpuSystemDuration DOUBLE,
+    HostDescription TEXT,
+    ResourceType TEXT);
+CREATE TABLE JobUsageRecord_Meta (
+    dbid INTEGER PRIMARY KEY,
+    ProbeName TEXT);
+CREATE TABLE Resource (
+    dbid INTEGER,
+    description TEXT,
+    value TEXT);
+CREATE TABLE Probe (
+    probeid INTEGER PRIMARY KEY,
+    probename TEXT UNIQUE,
+    siteid INTEGER);
+CREATE TABLE Site (
+    siteid INTEGER PRIMARY KEY,
+    SiteName TEXT);
+"""
+
+# created after loading, which is much faster than maintaining them;
+# without ANALYZE, SQLite prefers the ProbeName index to the EndTime one
+# even for an hour of jobs
+GratiaIndexes = """
+CREATE INDEX JobUsageRecordEndTime ON JobUsageRecord (EndTime);
+CREATE INDEX JobUsageRecord_MetaProbeName ON JobUsageRecord_Meta (ProbeName);
+CREATE INDEX ResourceDbid ON Resource (dbid, description);
+ANALYZE;
+"""
+
+# (probe, site, weight), the first one is the probe of the report
+Probes = [("condor:glidein-2.t2.ucsd.edu", "UCSD", 80),
+          ("condor:glidein-1.t2.ucsd.edu", "UCSD", 15),
+          ("condor:red.unl.edu", "Nebraska", 5)]
+
+# (HostDescription, weight); the first four are the sites of the 4-site report
+Sites = [("UCSD", 30), ("Nebraska", 20), ("Purdue", 15), ("GLOW", 10),
+         ("Caltech", 8), ("MIT", 6), ("Florida", 5), ("FNAL", 4), ("Vanderbilt", 2)]
+
+# (ExitCode, weight)
+ExitCodes = [("0", 6500), ("84", 50), ("1", 1500), ("2", 400),
+             ("137", 800), ("143", 500), ("255", 250)]
+
+OverflowFraction = 0.03
+PilotFraction = 0.95
+
+def WeightedChooser(choices, generator):
+    '''
+    Return a function picking one value of (value, weight) choices
+    '''
+    values = []
+    cumulative = []
+    total = 0
+    for value, weight in choices:
+        total += weight
+        values.append(value)
+        cumulative.append(total)
+    def choose():
+        point = generator.random() * total
+        for value, limit in zip(values, cumulative):
+            if point < limit:
+                return value
+        return values[-1]
+    return choose
+
+
+def GenerateJobs(jobs, earliest, latest, seed):
+    '''
+    Yield (JobUsageRecord row, ProbeName, Resource rows) for jobs synthetic
+    jobs ending in [earliest, latest)
+    '''
+    generator = random.Random(seed)
+    chooseSite = WeightedChooser(Sites, generator)
+    chooseExitCode = WeightedChooser(ExitCodes, generator)
+    chooseProbe = WeightedChooser([(probe, weight) for probe, site, weight in Probes], generator)
+    users = ["/DC=org/DC=doegrids/OU=People/CN=User %d %d" % (user, 100000 + user * 7919) for user in range(200)]
+    # gratia keeps its times in UTC
+    earliestepoch = calendar.timegm(earliest.timetuple())
+    span = calendar.timegm(latest.timetuple()) - earliestepoch
+    for dbid in xrange(1, jobs + 1):
+        site = chooseSite()
+        if generator.random() < OverflowFraction:
+            hostdescription = site + "-overflow"
+        else:
+            hostdescription = site
+        wallduration = min(float(int(generator.expovariate(1.0 / 14400))), 172800.0)
+        if generator.random() < 0.02:
+            # pilots that never started a job
+            wallduration = 0.0
+        cpuduration = wallduration * min(generator.betavariate(5, 1.5) * 1.05, 1.2)
+        # records reach gratia soon after the job ends, so the end times
+        # roughly follow dbid
+        endepoch = earliestepoch + min(span * (dbid - 1) / jobs + generator.random() * 3600, span - 1)
+        endtime = datetime.utcfromtimestamp(int(endepoch))
+        starttime = endtime - timedelta(0, wallduration)
+        if generator.random() < PilotFraction:
+            resourcetype = "BatchPilot"
+        else:
+            resourcetype = "Batch"
+        exitcode = chooseExitCode()
+        row = (dbid, "%d.%d" % (100000 + dbid / 10, dbid % 10), generator.choice(users),
+               "node%d.%s.edu" % (generator.randint(1, 500), site.lower()),
+               starttime.strftime("%Y-%m-%d %H:%M:%S"), endtime.strftime("%Y-%m-%d %H:%M:%S"),
+               wallduration, round(cpuduration * 0.95), round(cpuduration * 0.05),
+               hostdescription, resourcetype)
+        resources = [(dbid, "ExitCode", exitcode),
+                     (dbid, "ExitSignal", exitcode == "137" and "9" or "0"),
+                     (dbid, "condor.JobStatus", "4")]
+        yield row, chooseProbe(), resources
+
+
+def FillGratia(path, jobs, earliest, latest, seed, batchsize=100000):
+    '''
+    Create the synthetic gratia database in the SQLite file path
+    '''
+    if os.path.exists(path):
+        os.remove(path)
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA journal_mode=OFF")
+    db.execute("PRAGMA synchronous=OFF")
+    db.executescript(GratiaSchema)
+    sites = sorted(set([site for probe, site, weight in Probes]))
+    db.executemany("INSERT INTO Site VALUES (?, ?)", [(index + 1, site) for index, site in enumerate(sites)])
+    db.executemany("INSERT INTO Probe VALUES (?, ?, ?)",
+                   [(index + 1, probe, sites.index(site) + 1) for index, (probe, site, weight) in enumerate(Probes)])
+    started = time.time()
+    records = []
+    metas = []
+    resources = []
+    for row, probename, jobresources in GenerateJobs(jobs, earliest, latest, seed):
+        records.append(row)
+        metas.append((row[0], probename))
+        resources.extend(jobresources)
+        if len(records) >= batchsize:
+            InsertJobs(db, records, metas, resources)
+            records, metas, resources = [], [], []
+            print >>sys.stderr, "%d jobs, %.0f jobs/s" % (row[0], row[0] / (time.time() - started))
+    InsertJobs(db, records, metas, resources)
+    print >>sys.stderr, "indexing"
+    db.executescript(GratiaIndexes)
+    db.commit()
+    db.close()
+    print >>sys.stderr, "%d jobs in %.0fs" % (jobs, time.time() - started)
+
+
+def InsertJobs(db, records, metas, resources):
+    '''
+    Insert one batch of jobs
+    '''
+    db.executemany("INSERT INTO JobUsageRecord VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", records)
+    db.executemany("INSERT INTO JobUsageRecord_Meta VALUES (?, ?)", metas)
+    db.executemany("INSERT INTO Resource VALUES (?, ?, ?)", resources)
+
+
+'''
+Synthetic xrootd log.  GetOverflowjobsInfo7.py reads the xrootd logs of
+Nebraska, which are written in US/Central time, and looks for the
+overflow jobs with exit code 84 among their logins and disconnections.
+WriteXrootdLog writes such a log for the jobs of a synthetic gratia
+file: every exit 84 overflow job logs in within 10 minutes of its start,
+is redirected, and disconnects within 10 minutes of its end (so that the
+report matches it), and the rest of the lines are other clients' records
+and the usual chatter the parser has to skip.
+'''
+XrootdSites = ["cmssrv32.fnal.gov:1094", "xrootd.unl.edu:1094", "xrootd.t2.ucsd.edu:1094"]
+
+def XrootdLogTime(epoch):
+    '''
+    Return the "yymmdd hh:mm:ss" of an epoch in the log's local time
+    '''
+    return time.strftime("%y%m%d %H:%M:%S", time.localtime(epoch))
+
+
+def WriteXrootdLog(gratiapath, logpath, lines, seed):
+    '''
+    Write an xrootd log of about lines lines for the jobs of the synthetic
+    gratia file gratiapath
+    '''
+    os.environ['TZ'] = "US/Central"
+    time.tzset()
+    generator = random.Random(seed)
+    db = sqlite3.connect(gratiapath, detect_types=sqlite3.PARSE_DECLTYPES)
+    jobs = db.execute("""
+    SELECT JUR.dbid, Host, StartTime, EndTime
+    from JobUsageRecord JUR
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      ResourceType = "BatchPilot"
+      AND RESC.value = 84
+      AND HostDescription like '%-overflow'
+    """).fetchall()
+    earliest, latest = db.execute("SELECT MIN(EndTime), MAX(EndTime) FROM JobUsageRecord").fetchone()
+    db.close()
+    records = []
+    for dbid, host, starttime, endtime in jobs:
+        # the same conversion as the report, see CheckJobMatchInXrootdLog
+        beginat = int(time.mktime(starttime.utctimetuple())) - time.timezone
+        endat = int(time.mktime(endtime.utctimetuple())) - time.timezone
+        jobid = "cms%03d.%d:%d@%s" % (dbid % 1000, dbid, generator.randint(10, 99), host.split(" ")[0])
+        login = beginat + generator.randint(0, 600)
+        disconnection = max(login, endat - generator.randint(0, 600))
+        duration = disconnection - login
+        records.append((login, "%s %d XrootdXeq: %s login\n" % (XrootdLogTime(login), 4000 + dbid % 1000, jobid)))
+        records.append((login + 1, "%s %d Decode xrootd redirects %s to %s /store/mc/Fall11/file%d.root\n" % (
+            XrootdLogTime(login + 1), 4000 + dbid % 1000, jobid, generator.choice(XrootdSites), dbid)))
+        records.append((disconnection, "%s %d XrootdXeq: %s disc %d:%02d:%02d\n" % (
+            XrootdLogTime(disconnection), 4000 + dbid % 1000, jobid, duration / 3600, duration / 60 % 60, duration % 60)))
+    # MIN() and MAX() lose the TIMESTAMP type, so they come back as text
+    firstepoch = calendar.timegm(time.strptime(earliest, "%Y-%m-%d %H:%M:%S"))
+    lastepoch = calendar.timegm(time.strptime(latest, "%Y-%m-%d %H:%M:%S"))
+    for index in xrange(max(0, lines - len(records))):
+        epoch = generator.randint(firstepoch, lastepoch)
+        stamp = XrootdLogTime(epoch)
+        pid = generator.randint(1000, 9999)
+        client = "user%d.%d:%d@node%d.example.edu" % (generator.randint(1, 300), pid, generator.randint(10, 99), generator.randint(1, 2000))
+        kind = generator.random()
+        if kind < 0.05:
+            line = "%s %d XrootdXeq: %s login\n" % (stamp, pid, client)
+        elif kind < 0.10:
+            line = "%s %d XrootdXeq: %s disc 0:%02d:%02d\n" % (stamp, pid, client, generator.randint(0, 59), generator.randint(0, 59))
+        elif kind < 0.15:
+            line = "%s %d Decode xrootd redirects %s to %s /store/user/file%d.root\n" % (stamp, pid, client, generator.choice(XrootdSites), index)
+        elif kind < 0.20:
+            line = "%s %d XrootdXeq: %s pub IPv4 login as %s\n" % (stamp, pid, client, client.split(".")[0])
+        elif kind < 0.60:
+            line = "%s %d %s ofs_open: 0-600 fn=/store/user/file%d.root\n" % (stamp, pid, client, index)
+        elif kind < 0.90:
+            line = "%s %d %s ofs_close: use=0 fn=/store/user/file%d.root\n" % (stamp, pid, client, index)
+        else:
+            line = "%s %d XrdXeq: %s set monitor mode\n" % (stamp, pid, client)
+        records.append((epoch, line))
+    records.sort()
+    logfile = open(logpath, "w")
+    for epoch, line in records:
+        logfile.write(line)
+    logfile.close()
+    print >>sys.stderr, "%d log lines, %d exit 84 overflow jobs" % (len(records), len(jobs))
+
+
+def main():
+    parser = OptionParser(usage="%prog [options] FILE")
+    parser.add_option("--jobs", dest="jobs", default=1000000, type="int",
+                      help="number of jobs (default: %default)")
+    parser.add_option("--days", dest="days", default=2, type="int",
+                      help="spread the end times over this many days (default: %default)")
+    parser.add_option("--end", dest="end", default=None,
+                      help="latest end time, YYYY-MM-DD (default: now)")
+    parser.add_option("--seed", dest="seed", default=1, type="int",
+                      help="random seed (default: %default)")
+    parser.add_option("--xrootd-log", dest="xrootdlog", default=None,
+                      help="also write an xrootd log for the jobs into this file")
+    parser.add_option("--log-lines", dest="loglines", default=1000000, type="int",
+                      help="number of lines of the xrootd log (default: %default)")
+    parser.add_option("--log-only", dest="logonly", default=False, action="store_true",
+                      help="only write the xrootd log, for an existing FILE")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("give the SQLite file to create")
+    if options.logonly and not options.xrootdlog:
+        parser.error("--log-only needs --xrootd-log")
+    if options.end:
+        latest = datetime.strptime(options.end, "%Y-%m-%d")
+    else:
+        latest = datetime.utcnow()
+    if not options.logonly:
+        FillGratia(args[0], options.jobs, latest - timedelta(options.days), latest, options.seed)
+    if options.xrootdlog:
+        WriteXrootdLog(args[0], options.xrootdlog, options.loglines, options.seed)
+
+
+if __name__ == "__main__":
+    main()
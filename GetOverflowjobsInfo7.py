@@ -32,15 +32,33 @@ for cmssrv32.fnal.gov:1094:
 '''
 
 import os
+import sys
 from sets import Set
 import re
 import time
 from time import gmtime, strftime
 from datetime import datetime, date, timedelta;
-from pytz import timezone
+from pytz import timezone, utc
 import MySQLdb
+import MySQLdb.cursors
 import ConfigParser
 import string
+import itertools
+import calendar
+import threading
+import multiprocessing
+import Queue
+import json
+import StringIO
+import mmap
+import subprocess
+import sqlite3
+from optparse import OptionParser
+try:
+    import numpy
+except ImportError:
+    # only the client-side strategies need numpy
+    numpy = None
 
 '''
 Job Latest End Time
@@ -73,17 +91,43 @@ Nebraskaoffset = time.timezone/3600
 #print LatestEndTime
 #print EarliestEndTime
 
-def ConnectDatabase():
+def ConnectGratia():
     '''
-    Connect to rcf-gratia.unl.edu, and prepare database gratia for querying
+    Open a new connection to database gratia on rcf-gratia.unl.edu (or
+    to the SQLite file main was given, see SQLiteConnection)
     '''
+    if GratiaSQLiteFile is not None:
+        db = SQLiteConnection(GratiaSQLiteFile)
+        if QueryLog is not None:
+            db = InstrumentedConnection(db, QueryLog, QueryLogExplain)
+        return db
     # read configuration file, get username and password of one user
     config = ConfigParser.ConfigParser()
     config.read("mygratiaDBpwd.ini")
     username = config.get("rcf-gratia", "username")
     password = config.get("rcf-gratia", "password")
+    # a copy of gratia elsewhere can be given with host, port and database
+    host = "rcf-gratia.unl.edu"
+    port = 49152
+    database = "gratia"
+    if config.has_option("rcf-gratia", "host"):
+        host = config.get("rcf-gratia", "host")
+    if config.has_option("rcf-gratia", "port"):
+        port = config.getint("rcf-gratia", "port")
+    if config.has_option("rcf-gratia", "database"):
+        database = config.get("rcf-gratia", "database")
     # connect with the database
-    db = MySQLdb.connect("rcf-gratia.unl.edu", username, password, "gratia", 49152)
+    db = MySQLdb.connect(host, username, password, database, port)
+    if QueryLog is not None:
+        db = InstrumentedConnection(db, QueryLog, QueryLogExplain)
+    return db
+
+
+def ConnectDatabase():
+    '''
+    Connect to rcf-gratia.unl.edu, and prepare database gratia for querying
+    '''
+    db = ConnectGratia()
 
     # prepare a cursor oject using cursor() method
     cursor = db.cursor()
@@ -92,7 +136,576 @@ def ConnectDatabase():
     return db, cursor
 
 
-def QueryGratia(cursor):
+'''
+SQLite backend.  Instead of rcf-gratia.unl.edu, main can point the
+script at an SQLite file with the gratia tables the report reads (see
+GenerateSyntheticGratia.py), to run and measure it offline.  The
+queries are written for MySQLdb, so the connection translates its
+%s parameters and %% escapes to the sqlite3 ones; the rest of the SQL
+they use means the same in SQLite.  SQLite cursors already step through
+results as they are fetched, so the cursor class asked for (SSCursor)
+is ignored.  A local MySQL copy of gratia needs no backend of its own:
+give its host, port and database in mygratiaDBpwd.ini.
+'''
+GratiaSQLiteFile = None
+
+class SQLiteCursor(object):
+    '''
+    A sqlite3 cursor accepting the MySQLdb parameter style
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def execute(self, querystring, parameters=None):
+        querystring = querystring.replace("%s", "?").replace("%%", "%")
+        if parameters is None:
+            parameters = ()
+        self.cursor.execute(querystring, parameters)
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class SQLiteConnection(object):
+    '''
+    A sqlite3 connection standing in for a MySQLdb one
+    '''
+
+    def __init__(self, path):
+        # the pool and the exit 84 stream hand connections to other threads
+        self.connection = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False)
+
+    def cursor(self, *arguments):
+        return SQLiteCursor(self.connection.cursor())
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+'''
+Query instrumentation.  When main is asked for a query log, every
+connection from ConnectGratia is wrapped so that each statement records
+where it was executed from, its wall time (execute and fetch), the rows
+and bytes it returned and, optionally, its EXPLAIN.  The records are
+written to a JSON file at the end of the run.
+'''
+QueryLog = None
+QueryLogExplain = False
+
+def RowBytes(rows):
+    '''
+    Size of the values in rows.  MySQL sends results as text, so this is
+    close to the payload on the wire (without the protocol overhead).
+    '''
+    total = 0
+    for row in rows:
+        for value in row:
+            if value is not None:
+                total += len(str(value))
+    return total
+
+
+class InstrumentedCursor(object):
+    '''
+    A cursor that records every statement it executes into log
+    '''
+
+    def __init__(self, cursor, connection, log, explain):
+        self.cursor = cursor
+        self.connection = connection
+        self.log = log
+        self.explain = explain
+        self.record = None
+
+    def execute(self, querystring, parameters=None):
+        caller = sys._getframe(1)
+        record = {"caller": "%s:%d" % (caller.f_code.co_name, caller.f_lineno),
+                  "query": " ".join(querystring.split()),
+                  "parameters": [str(parameter) for parameter in parameters or ()],
+                  "rows": 0, "bytes": 0, "fetch_seconds": 0.0}
+        if self.explain:
+            record["explain"] = self.Explain(querystring, parameters)
+        start = time.time()
+        try:
+            return self.cursor.execute(querystring, parameters)
+        finally:
+            record["execute_seconds"] = time.time() - start
+            self.log.append(record)
+            self.record = record
+
+    def Explain(self, querystring, parameters):
+        '''
+        Return the EXPLAIN rows of a statement as dictionaries; a failing
+        EXPLAIN is recorded, not raised
+        '''
+        try:
+            cursor = self.connection.cursor()
+            try:
+                cursor.execute("EXPLAIN " + querystring, parameters)
+                names = [description[0] for description in cursor.description]
+                return [dict(zip(names, row)) for row in cursor.fetchall()]
+            finally:
+                cursor.close()
+        except Exception, error:
+            return str(error)
+
+    def Fetched(self, rows, start):
+        self.record["fetch_seconds"] += time.time() - start
+        self.record["rows"] += len(rows)
+        self.record["bytes"] += RowBytes(rows)
+
+    def fetchone(self):
+        start = time.time()
+        row = self.cursor.fetchone()
+        if row is None:
+            self.Fetched([], start)
+        else:
+            self.Fetched([row], start)
+        return row
+
+    def fetchmany(self, size):
+        start = time.time()
+        rows = self.cursor.fetchmany(size)
+        self.Fetched(rows, start)
+        return rows
+
+    def fetchall(self):
+        start = time.time()
+        rows = self.cursor.fetchall()
+        self.Fetched(rows, start)
+        return rows
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class InstrumentedConnection(object):
+    '''
+    A connection whose cursors are InstrumentedCursor
+    '''
+
+    def __init__(self, connection, log, explain):
+        self.connection = connection
+        self.log = log
+        self.explain = explain
+
+    def cursor(self, *arguments):
+        return InstrumentedCursor(self.connection.cursor(*arguments), self.connection, self.log, self.explain)
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+
+def WriteQueryLog(path, log, started):
+    '''
+    Write the statements recorded during this run to a JSON file
+    '''
+    for record in log:
+        record["seconds"] = record["execute_seconds"] + record["fetch_seconds"]
+    sidecar = {"started": started.strftime("%Y-%m-%d %H:%M:%S"),
+               "EarliestEndTime": EarliestEndTime.strftime("%Y-%m-%d %H:%M:%S"),
+               "LatestEndTime": LatestEndTime.strftime("%Y-%m-%d %H:%M:%S"),
+               "arguments": sys.argv[1:],
+               "seconds": time.time() - time.mktime(started.timetuple()),
+               "queries": log}
+    outfile = open(path, "w")
+    try:
+        json.dump(sidecar, outfile, indent=2, sort_keys=True, default=str)
+        outfile.write("\n")
+    finally:
+        outfile.close()
+
+
+class ConnectionPool(object):
+    '''
+    A small pool of connections to gratia.  A MySQLdb connection must not
+    be used by two threads at once, so every parallel query borrows its
+    own connection.  At most size connections are opened, lazily.
+    '''
+
+    def __init__(self, connect, size):
+        self.connect = connect
+        self.size = size
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.connections = []
+
+    def get(self):
+        '''
+        Borrow a connection, waiting for one when size are in use
+        '''
+        self.lock.acquire()
+        try:
+            opennew = self.idle.empty() and len(self.connections) < self.size
+            if opennew:
+                connection = self.connect()
+                self.connections.append(connection)
+        finally:
+            self.lock.release()
+        if opennew:
+            return connection
+        return self.idle.get()
+
+    def put(self, connection):
+        '''
+        Give back a borrowed connection
+        '''
+        self.idle.put(connection)
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+
+
+class QueryExecutor(object):
+    '''
+    Run independent queries in parallel threads, at most maxworkers at a
+    time, each on a connection of the pool.  A task is a function taking
+    a cursor; run() starts the tasks and returns at once, wait() returns
+    their results in order.  MySQLdb releases the GIL while waiting for
+    the server, so the round trips overlap.
+    '''
+
+    def __init__(self, pool, maxworkers):
+        self.pool = pool
+        self.maxworkers = maxworkers
+        self.threads = []
+
+    def run(self, tasks):
+        self.results = [None] * len(tasks)
+        self.errors = []
+        self.pending = Queue.Queue()
+        for index, task in enumerate(tasks):
+            self.pending.put((index, task))
+        self.threads = []
+        for i in range(min(self.maxworkers, len(tasks))):
+            thread = threading.Thread(target=self.work)
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while 1:
+            try:
+                index, task = self.pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                connection = self.pool.get()
+            except Exception:
+                # no connection for this worker (too many connections,
+                # say); the others go on, and wait() raises the error
+                self.errors.append(sys.exc_info())
+                return
+            try:
+                try:
+                    cursor = connection.cursor()
+                    self.results[index] = task(cursor)
+                    cursor.close()
+                except Exception:
+                    self.errors.append(sys.exc_info())
+            finally:
+                self.pool.put(connection)
+
+    def wait(self):
+        '''
+        Wait for every task, and return their results.  If a task failed,
+        its exception is raised here.
+        '''
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            errortype, errorvalue, errortraceback = self.errors[0]
+            raise errortype, errorvalue, errortraceback
+        return self.results
+
+
+# Every statistic in the report is built from the same few aggregates,
+# computed for the overflow jobs, the normal jobs and (for the 4 sites)
+# all jobs together.  The query strategies below only differ in how they
+# get these numbers out of gratia; PrintReport turns them into the report.
+GlideinProbeName = "condor:glidein-2.t2.ucsd.edu"
+
+# Efficiency (CpuUserDuration+CpuSystemDuration)/WallDuration histogram:
+# bin 0 holds efficiencies <= 0.05, bin k those in (edge k-1, edge k],
+# the last bin those > 1.  Jobs without an efficiency (no walltime) are
+# in no bin.  Bins are closed on the right like "> 0.8", so the number
+# of jobs above any edge is exact.
+EfficiencyBinEdges = [k / 20.0 for k in range(1, 21)]
+EfficiencyBins = len(EfficiencyBinEdges) + 1
+EfficiencyExpression = "(CpuUserDuration+CpuSystemDuration)/WallDuration"
+
+def EfficiencyBinKeys(efficiencybin):
+    '''
+    Return the (jobs, walltime) statistics keys of one efficiency bin
+    '''
+    return ["NumEfficiencyBin%02d" % efficiencybin, "WallDurationEfficiencyBin%02d" % efficiencybin]
+
+
+def EfficiencyBinExpression(low=0, high=EfficiencyBins - 1):
+    '''
+    Return the SQL expression of the efficiency bin of a job (NULL when
+    it has no efficiency), among bins low to high.  The CASEs are nested
+    as a binary search, so a row computes its efficiency some 5 times
+    rather than up to 21.  NULL takes every ELSE, down to the test of
+    the last bin.
+    '''
+    if low == high and high == EfficiencyBins - 1:
+        return "CASE WHEN %s > %r THEN %d END" % (EfficiencyExpression, EfficiencyBinEdges[-1], high)
+    if low == high:
+        return "%d" % low
+    middle = (low + high) // 2
+    return "CASE WHEN %s <= %r THEN %s ELSE %s END" % (EfficiencyExpression, EfficiencyBinEdges[middle],
+                                                       EfficiencyBinExpression(low, middle),
+                                                       EfficiencyBinExpression(middle + 1, high))
+
+
+JobStatisticsKeys = ["Num", "WallDuration", "UserAndSystemDuration",
+                     "NumExitCode0", "WallDurationExitCode0",
+                     "NumExitCode84", "WallDurationExitCode84",
+                     "NumEfficiencyGT80percent"]
+for efficiencybin in range(EfficiencyBins):
+    JobStatisticsKeys.extend(EfficiencyBinKeys(efficiencybin))
+
+def NewJobStatistics():
+    '''
+    Return an empty set of aggregates for one population of jobs
+    '''
+    statistics = {}
+    for key in JobStatisticsKeys:
+        statistics[key] = 0
+    return statistics
+
+
+def NewReportStatistics():
+    '''
+    Return empty aggregates for every population in the report
+    key        value
+    AllSites   {Overflow, Normal, All} -> job statistics
+    FourSites  {Overflow, Normal, All} -> job statistics
+    '''
+    statistics = {}
+    for sitegroup in ["AllSites", "FourSites"]:
+        statistics[sitegroup] = {}
+        for population in ["Overflow", "Normal", "All"]:
+            statistics[sitegroup][population] = NewJobStatistics()
+    return statistics
+
+
+def AddRowToJobStatistics(statistics, keys, row):
+    '''
+    Add one row of COUNT(*)/SUM() results to a set of aggregates.  Columns
+    named Num* are counts, all the others are durations in seconds.  SUM()
+    over no rows comes back as NULL, which we count as 0.
+    '''
+    for key, value in zip(keys, row):
+        if value is None:
+            continue
+        if key.startswith("Num"):
+            statistics[key] += int(value)
+        else:
+            statistics[key] += float(value)
+
+
+def MergeReportStatistics(statistics, partial):
+    '''
+    Add the report aggregates partial to statistics.  Every aggregate is a
+    count or a sum, so aggregates of disjoint sets of jobs simply add up.
+    '''
+    for sitegroup in partial:
+        for population in partial[sitegroup]:
+            AddRowToJobStatistics(statistics[sitegroup][population], JobStatisticsKeys,
+                                  [partial[sitegroup][population][key] for key in JobStatisticsKeys])
+
+
+'''
+Site groups.  The second half of the report is restricted to the jobs of
+a group of sites, recognized by substrings of their HostDescription (by
+default UCSD, Nebraska, Wisconsin (GLOW) and Purdue); main can read
+another group from a file:
+    [FourSites]
+    title = UCSD+Nebraska+Wisconsin+Purdue
+    patterns = Nebraska, UCSD, Purdue, GLOW
+Like the LIKE conditions they replace, patterns are case-insensitive.
+Leading-wildcard LIKEs cannot use an index, so instead the HostDescription
+of the group are resolved once per run from the distinct HostDescription
+of the probe, and the queries filter with an IN list.  The distinct
+HostDescription seen so far are kept in a JSON file across runs together
+with the highest dbid looked at, so that later runs only look at the new
+jobs (an index range on the primary key).  The first run starts from the
+lowest dbid of the report window, not from the probe's whole history.
+Without a file, they are looked up within the report window.  The 4-site queries also need the
+probe to have a Site, which is checked once here too.
+'''
+FourSitesTitle = "UCSD+Nebraska+Wisconsin+Purdue"
+FourSitesPatterns = ["Nebraska", "UCSD", "Purdue", "GLOW"]
+SiteGroupCacheFile = None
+
+def ReadSiteGroups(path):
+    '''
+    Return the (title, patterns) of the 4-site group in a site group file
+    '''
+    config = ConfigParser.ConfigParser()
+    if not config.read(path):
+        raise IOError("cannot read site group file %s" % path)
+    patterns = [pattern.strip() for pattern in config.get("FourSites", "patterns").split(",")]
+    patterns = [pattern for pattern in patterns if pattern]
+    if config.has_option("FourSites", "title"):
+        title = config.get("FourSites", "title")
+    else:
+        title = "+".join(patterns)
+    return title, patterns
+
+
+def MatchesFourSites(hostdescription):
+    '''
+    Whether a (non NULL) HostDescription belongs to the 4-site group
+    '''
+    lowered = hostdescription.lower()
+    for pattern in FourSitesPatterns:
+        if lowered.find(pattern.lower()) >= 0:
+            return True
+    return False
+
+
+def FetchHostDescriptions(cursor, probename, lowdbid=None, earliest=None, latest=None):
+    '''
+    Return the highest dbid and the distinct HostDescription of the jobs
+    of a probe, either above dbid lowdbid or within a window
+    '''
+    querystring = """
+    SELECT
+        MAX(JUR.dbid), HostDescription
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    where
+      %s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%%s
+    GROUP BY HostDescription
+     """
+    if earliest is None:
+        querystring = querystring % "JUR.dbid>%s"
+        parameters = (lowdbid, probename)
+    else:
+        querystring = querystring % "EndTime>=%s and EndTime<%s"
+        parameters = (earliest, latest, probename)
+    cursor.execute(querystring, parameters)
+    highdbid = lowdbid
+    hostdescriptions = []
+    for dbid, hostdescription in cursor.fetchall():
+        highdbid = max(highdbid, int(dbid))
+        if hostdescription is not None:
+            hostdescriptions.append(hostdescription)
+    return highdbid, hostdescriptions
+
+
+def ReadSiteGroupCache(path):
+    '''
+    Return the content of the HostDescription cache, or an empty one
+    '''
+    try:
+        cachefile = open(path)
+    except IOError:
+        return {}
+    try:
+        return json.load(cachefile)
+    except ValueError:
+        # a cache we cannot read is rebuilt
+        return {}
+    finally:
+        cachefile.close()
+
+
+def WriteSiteGroupCache(path, cache):
+    '''
+    Replace the HostDescription cache atomically
+    '''
+    temporary = path + ".tmp"
+    cachefile = open(temporary, "w")
+    json.dump(cache, cachefile)
+    cachefile.close()
+    os.rename(temporary, path)
+
+
+# probename -> HostDescription of the 4-site group, see ResolveFourSites
+fourSitesDictionary = {}
+
+def ResolveFourSites(cursor, probename):
+    '''
+    Return the sorted HostDescription of the 4-site group for the probe
+    (none if the probe has no Site)
+    '''
+    if probename in fourSitesDictionary:
+        return fourSitesDictionary[probename]
+    hostdescriptions = []
+    if ProbeHasSite(cursor, probename):
+        if SiteGroupCacheFile is None:
+            highdbid, hostdescriptions = FetchHostDescriptions(cursor, probename, 0, EarliestEndTime, LatestEndTime)
+        else:
+            cache = ReadSiteGroupCache(SiteGroupCacheFile)
+            entry = cache.get(probename, None)
+            if entry is None:
+                # seed the cache from the report window (no jobs, nothing to seed)
+                dbidrange = WindowDbidRange(cursor, EarliestEndTime, LatestEndTime)
+                if dbidrange is not None:
+                    entry = {"dbid": dbidrange[0] - 1, "HostDescriptions": []}
+                    cache[probename] = entry
+            if entry is not None:
+                highdbid, hostdescriptions = FetchHostDescriptions(cursor, probename, entry["dbid"])
+                if hostdescriptions or highdbid != entry["dbid"]:
+                    entry["dbid"] = highdbid
+                    entry["HostDescriptions"] = sorted(set(entry["HostDescriptions"]) | set(hostdescriptions))
+                    WriteSiteGroupCache(SiteGroupCacheFile, cache)
+                hostdescriptions = entry["HostDescriptions"]
+    foursites = sorted(set([hostdescription for hostdescription in hostdescriptions
+                            if MatchesFourSites(hostdescription)]))
+    fourSitesDictionary[probename] = foursites
+    return foursites
+
+
+def FourSitesCondition(cursor, probename):
+    '''
+    Return the condition restricting a query to the 4-site group, and its
+    parameters
+    '''
+    foursites = ResolveFourSites(cursor, probename)
+    if not foursites:
+        return "HostDescription IN (NULL)", ()
+    return "HostDescription IN (" + ", ".join(["%s"] * len(foursites)) + ")", tuple(foursites)
+
+
+def FourSitesLikeCondition():
+    '''
+    Return the condition of the 4-site group as LIKE tests, for the
+    single scan where it is only a CASE and no index could help anyway,
+    and its parameters.  The patterns are matched literally, as in
+    MatchesFourSites: their \\, % and _ are escaped (T2_US_UCSD has an
+    underscore).  The escape character is a parameter too, since MySQL and
+    SQLite read a backslash in a string literal differently.
+    '''
+    if not FourSitesPatterns:
+        return "0=1", ()
+    condition = "(" + " or ".join(["HostDescription like %s escape %s"] * len(FourSitesPatterns)) + ")"
+    parameters = []
+    for pattern in FourSitesPatterns:
+        pattern = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        parameters.extend(["%" + pattern + "%", "\\"])
+    return condition, tuple(parameters)
+
+
+def QueryGratia(cursor, strategy="perquery"):
 
     '''
     Query database gratia, and compute the following:
@@ -109,9 +722,44 @@ def QueryGratia(cursor):
     the efficiency of normal jobs
     (5) the percentage of number of overflow jobs whose efficiency is greater than 80%, 
     the percentage of number of normal jobs whose efficiency is greater than 80%
+
+    strategy selects how the numbers are fetched (see QueryGratiaStrategies):
+    perquery    one SELECT per number, 20 scans of the window
+    singlescan  one SELECT with conditional aggregates, 1 scan of the window
+    columnar    one SELECT of a narrow per-job projection, aggregated
+                client-side with numpy
+    hashjoin    the columnar projection without Resource, plus one range
+                read of the ExitCode rows, joined client-side
+    paged       the columnar projection in keyset pages of dbid, aggregated
+                page by page
+    grouped     one SELECT of partial sums GROUP BY HostDescription, with
+                the overflow and 4-site tests done client-side
+    incremental only the jobs added since the last run, appended to a
+                local store the report is computed from
+    rollup      the grouped scan, kept per day in a local rollup file
+    All of them print the same report.  Return the report aggregates.
+    '''
+    statistics = QueryGratiaStrategies[strategy](cursor)
+    PrintReport(statistics)
+    return statistics
+
+
+def QueryGratiaPerQuery(cursor):
+    '''
+    Fetch the report aggregates with one SELECT per number
+    '''
+    statistics = QueryGratiaPerQueryAllSites(cursor)
+    MergeReportStatistics(statistics, QueryGratiaPerQueryFourSites(cursor))
+    return statistics
+
+
+def QueryGratiaPerQueryAllSites(cursor):
+    '''
+    Fetch the all-sites aggregates with one SELECT per number
     '''
 
     # The database keeps its begin/end times in UTC.
+    statistics = NewReportStatistics()
 
     # Compute number (wallduration, CpuUserDuration+CpuSystemDuration) of overflow jobs in all sites
     querystring = """
@@ -128,20 +776,8 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone();
-    NumOverflowJobs = int(row[0])
-    if (NumOverflowJobs==0):
-        WallDurationOverflowJobs = 0
-        UserAndSystemDurationOverflowJobs = 0
-    else:
-        WallDurationOverflowJobs = float(row[1])
-        UserAndSystemDurationOverflowJobs = float(row[2])
+    AddRowToJobStatistics(statistics["AllSites"]["Overflow"], ["Num", "WallDuration", "UserAndSystemDuration"], row)
 
-    # Compute efficiency of overflow jobs, which is equal to (CpuUserDuration+CpuSystemDuration)/WallDuration (in all sites)
-    if (WallDurationOverflowJobs==0):
-        EfficiencyOverflowJobs = 0
-    else:
-        EfficiencyOverflowJobs = float(100* UserAndSystemDurationOverflowJobs)/WallDurationOverflowJobs;
-    
     # compute number (wallduration, CpuUserDuration+CpuSystemDuration) of normal jobs (in all sites)
     querystring = """
     SELECT
@@ -157,38 +793,9 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone();
-    NumNormalJobs = int(row[0])
-    NumAllJobs = NumOverflowJobs + NumNormalJobs
-    if (NumNormalJobs == 0):
-        WallDurationNormalJobs = 0
-        UserAndSystemDurationNormalJobs = 0
-    else:
-        WallDurationNormalJobs = float(row[1])  
-        UserAndSystemDurationNormalJobs = float(row[2])
-    WallDurationAllJobs = WallDurationNormalJobs + WallDurationNormalJobs
-    #print NumNormalJobs 
-
-    # Compute the efficiency of normal jobs (in all sites)
-    if (WallDurationNormalJobs == 0):
-        EfficiencyNormalJobs = 0
-    else:
-        EfficiencyNormalJobs = float(100*UserAndSystemDurationNormalJobs)/WallDurationNormalJobs
-
-    # Compute the percentage of number of overflow jobs OVER number of all jobs (in all sites)
-    if (NumAllJobs==0):
-        PercentageOverflowJobs = 0
-    else:
-        PercentageOverflowJobs = float(NumOverflowJobs*100)/NumAllJobs;
-    #print str(PercentageOverflowJobs)+"%"
- 
-    # Compute the percentage of walltime of overflow jobs OVER walltime of all jobs (in all sites)
-    if (WallDurationAllJobs==0):
-        PercentageWallDurationOverflowJobs = 0
-    else:
-        PercentageWallDurationOverflowJobs = float(WallDurationOverflowJobs*100)/WallDurationAllJobs;
-    #print str(PercentageWallDurationOverflowJobs)+"%"
+    AddRowToJobStatistics(statistics["AllSites"]["Normal"], ["Num", "WallDuration", "UserAndSystemDuration"], row)
 
-    # Compute the percentage of number (wallduration) of overflow jobs with exit code 0 OVER number of overflow jobs (in all sites)
+    # Compute the number (wallduration) of overflow jobs with exit code 0 (in all sites)
     querystring = """
     SELECT
         COUNT(*), SUM(WallDuration)
@@ -204,24 +811,9 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone()
-    NumOverflowJobsExitCode0 = int(row[0])
-    if (NumOverflowJobs==0):
-        PercentageExitCode0Overflow = 0
-    else:
-        PercentageExitCode0Overflow =float(100*NumOverflowJobsExitCode0)/ NumOverflowJobs
-    #print str(PercentageExitCode0Overflow) + "%"
-    if (NumOverflowJobsExitCode0==0):
-        WallDurationOverflowJobsExitCode0 = 0
-    else:
-        WallDurationOverflowJobsExitCode0 = float(row[1]) 
-
-    # Compute the walltime percentage of walltime of overflow jobs with exit code 0 OVER walltime of overflow jobs (in all sites)
-    if (WallDurationOverflowJobs==0):
-        PercentageWallDurationOverflowJobsExitCode0 = 0
-    else:
-        PercentageWallDurationOverflowJobsExitCode0 = float(100*WallDurationOverflowJobsExitCode0)/WallDurationOverflowJobs;
+    AddRowToJobStatistics(statistics["AllSites"]["Overflow"], ["NumExitCode0", "WallDurationExitCode0"], row)
   
-    # Compute the percentage of number normal jobs with exit code 0 OVER number of normal jobs (in all sites)
+    # Compute the number of normal jobs with exit code 0 (in all sites)
     querystring = """
     SELECT
         COUNT(*)
@@ -237,14 +829,9 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone()
-    NumNormalJobsExitCode0 = int(row[0])
-    if (NumNormalJobs==0):
-        PercentageExitCode0Normal = 0
-    else:
-        PercentageExitCode0Normal = float(100*NumNormalJobsExitCode0)/NumNormalJobs
-    #print str(PercentageExitCode0Normal) + "%"
+    AddRowToJobStatistics(statistics["AllSites"]["Normal"], ["NumExitCode0"], row)
     
-    # compute number of overflow jobs with exit code 84 (in all sites)
+    # compute number (wallduration) of overflow jobs with exit code 84 (in all sites)
     querystring = """
     SELECT
         COUNT(*), SUM(WallDuration)
@@ -260,25 +847,7 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone()
-    NumOverflowJobsExitCode84 = int(row[0])
-
-    # Compute the percentage of number of overflow jobs with exit code 84 OVER number of overflow jobs (in all sites)
-    if (NumOverflowJobs==0):
-        PercentageNumOverflowJobsExitCode84 = 0
-    else:
-        PercentageNumOverflowJobsExitCode84 = float(100*NumOverflowJobsExitCode84)/NumOverflowJobs;
-    #print str(PercentageNumOverflowJobsExitCode84)+"%"
-
-    # compute walltime of overflow jobs with exit code 84 (in all sites)
-    if (NumOverflowJobsExitCode84==0):
-        WallDurationOverflowJobsExitCode84 = 0
-    else:
-        WallDurationOverflowJobsExitCode84 = float(row[1])
-    #print str(WallDurationOverflowJobsExitCode84)
-
-    # Compute the percentage of walltime of overflow jobs with exit code 84 OVER walltime of overflow jobs (in all sites) 
-    PercentageWallDurationOverflowJobsExitCode84 = float(100*WallDurationOverflowJobsExitCode84)/WallDurationOverflowJobs;     
-    #print str(PercentageWallDurationOverflowJobsExitCode84)+"%"
+    AddRowToJobStatistics(statistics["AllSites"]["Overflow"], ["NumExitCode84", "WallDurationExitCode84"], row)
 
     # compute number of normal jobs with exit code 84 (in all sites)
     querystring = """
@@ -295,16 +864,10 @@ def QueryGratia(cursor):
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
-    NumNormalJobsExitCode84 = int(row[0])
-
-    # Compute the percentage of number of normal jobs with exit code 84 OVER number of normal jobs (in all sites) 
-    if (NumNormalJobs==0):
-        PercentageNumNormalJobsExitCode84 = 0
-    else:
-        PercentageNumNormalJobsExitCode84 = float(100*NumNormalJobsExitCode84)/NumNormalJobs
-    #print str(PercentageNumNormalJobsExitCode84)+"%"
+    row = cursor.fetchone()
+    AddRowToJobStatistics(statistics["AllSites"]["Normal"], ["NumExitCode84"], row)
 
-    # Compute the percentage of number of overflow jobs whose efficiency greater than 80% (in all sites)
+    # Compute the number of overflow jobs whose efficiency greater than 80% (in all sites)
     querystring = """
     SELECT
         COUNT(*)
@@ -320,14 +883,9 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone()
-    NumEfficiencyGT80percentOverflowJobs = int(row[0])
-    if (NumOverflowJobs == 0):
-        PercentageEfficiencyGT80percentOverflowJobs = 0
-    else:
-        PercentageEfficiencyGT80percentOverflowJobs = float(100*NumEfficiencyGT80percentOverflowJobs)/NumOverflowJobs
-    #print str(PercentageEfficiencyGT80percentOverflowJobs) + "%"
+    AddRowToJobStatistics(statistics["AllSites"]["Overflow"], ["NumEfficiencyGT80percent"], row)
 
-    # Compute the percentage of number of normal jobs whose efficiency greater than 80% (in all sites)
+    # Compute the number of normal jobs whose efficiency greater than 80% (in all sites)
     querystring = """
     SELECT
         COUNT(*)
@@ -343,12 +901,16 @@ def QueryGratia(cursor):
      """
     cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
     row = cursor.fetchone()
-    NumEfficiencyGT80percentNormalJobs = int(row[0])
-    if (NumNormalJobs == 0):
-        PercentageEfficiencyGT80percentNormalJobs = 0
-    else:
-        PercentageEfficiencyGT80percentNormalJobs = float(100*NumEfficiencyGT80percentNormalJobs)/NumNormalJobs
-    #print str(PercentageEfficiencyGT80percentNormalJobs) + "%"
+    AddRowToJobStatistics(statistics["AllSites"]["Normal"], ["NumEfficiencyGT80percent"], row)
+    return statistics
+
+
+def QueryGratiaPerQueryFourSites(cursor):
+    '''
+    Fetch the 4-site aggregates with one SELECT per number
+    '''
+    statistics = NewReportStatistics()
+    foursites, foursitesparameters = FourSitesCondition(cursor, GlideinProbeName)
  
     # Compute the number (walltime) of all jobs in 4 sites
     querystring = """
@@ -357,21 +919,15 @@ def QueryGratia(cursor):
     from JobUsageRecord JUR 
     JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
     where
       EndTime>=%s and EndTime<%s
       AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
+      AND """ + foursites + """
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
     row = cursor.fetchone()
-    NumAllJobs4sites = int(row[0])
-    if (NumAllJobs4sites==0):
-        WallDurationAllJobs4sites = 0
-    else:
-        WallDurationAllJobs4sites = float(row[1])
+    AddRowToJobStatistics(statistics["FourSites"]["All"], ["Num", "WallDuration", "UserAndSystemDuration"], row)
 
     # Compute the number of overflow jobs that in %UCSD%, %Nebraska%, %GLOW%, and %Purdue%
     querystring = """
@@ -380,118 +936,53 @@ def QueryGratia(cursor):
     from JobUsageRecord JUR 
     JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
     where
       EndTime>=%s and EndTime<%s
       AND HostDescription like '%%-overflow'
       AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
+      AND """ + foursites + """
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
     row = cursor.fetchone()
-    NumOverflowJobs4sites = int(row[0])
-    if (NumOverflowJobs4sites==0):
-        WallDurationOverflowJobs4sites = 0
-        UserAndSystemDurationOverflowJobs4sites = 0
-    else:
-        WallDurationOverflowJobs4sites = float(row[1])
-        UserAndSystemDurationOverflowJobs4sites = float(row[2])
-
-    # Compute the percentage of walltime of overflow jobs OVER walltime of all jobs (in 4 sites)
-
-    if (WallDurationAllJobs4sites == 0):
-        PercentageWallDurationOverflowJobs4sites = 0
-    else:
-        PercentageWallDurationOverflowJobs4sites = float(100*WallDurationOverflowJobs4sites)/WallDurationAllJobs4sites
-    #print str(PercentageWallDurationOverflowJobs4sites)+"%"
-
-    # Compute the efficiency of overflow jobs (in 4 sites)
-    if (WallDurationOverflowJobs4sites == 0):
-        EfficiencyOverflowJobs4sites = 0
-    else:
-        EfficiencyOverflowJobs4sites = float(100* UserAndSystemDurationOverflowJobs4sites)/WallDurationOverflowJobs4sites
-
-    #print str(NumOverflowJobs4sites)
+    AddRowToJobStatistics(statistics["FourSites"]["Overflow"], ["Num", "WallDuration", "UserAndSystemDuration"], row)
     
     # Compute the number (efficiency) of normal jobs (in 4 sites)
-
     querystring = """
     SELECT
         COUNT(*), SUM(WallDuration), SUM(CpuUserDuration+CpuSystemDuration)
     from JobUsageRecord JUR
     JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
     where
       EndTime>=%s and EndTime<%s
       AND HostDescription NOT like '%%-overflow'
       AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
+      AND """ + foursites + """
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
     row = cursor.fetchone()
-    NumNormalJobs4sites = int(row[0])
-    #print str(NumNormalJobs4sites)
-    if (NumNormalJobs4sites == 0):
-        UserAndSystemDurationNormalJobs4sites = 0
-        WallDurationNormalJobs4sites = 0
-    else:
-        UserAndSystemDurationNormalJobs4sites = float(row[2])
-        WallDurationNormalJobs4sites = float(row[1])
-    if (WallDurationNormalJobs4sites == 0):
-        EfficiencyNormalJobs4sites = 0
-    else:
-        EfficiencyNormalJobs4sites = float(100*UserAndSystemDurationNormalJobs4sites)/WallDurationNormalJobs4sites
-    #print str(EfficiencyNormalJobs4sites) + "%"
-  
-    # Compute the percentage of number of overflow jobs OVER number of all jobs (in 4 sites)
-    if (NumAllJobs4sites == 0):
-        PercentageOverflowJobs4sites = 0
-    else:
-        PercentageOverflowJobs4sites = float(100*NumOverflowJobs4sites)/NumAllJobs4sites;
-    #print str(PercentageOverflowJobs4sites) + "%"
+    AddRowToJobStatistics(statistics["FourSites"]["Normal"], ["Num", "WallDuration", "UserAndSystemDuration"], row)
    
-    # Compute the number of overflow jobs with exit code 0 (in 4 sites)
+    # Compute the number (walltime) of overflow jobs with exit code 0 (in 4 sites)
     querystring = """
     SELECT
         COUNT(*), SUM(WallDuration)
     from JobUsageRecord JUR 
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
     JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
     where
       EndTime>=%s and EndTime<%s
       AND RESC.value = 0
       AND HostDescription like '%%-overflow'
       AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
+      AND """ + foursites + """
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
     row = cursor.fetchone()
-    NumOverflowJobsExitCode0foursites = int(row[0])
-
-    # Compute the percentage of number of overflow jobs with exit code 0 OVER number of overflow jobs (in 4 sites)
-    if (NumOverflowJobs4sites == 0):
-        PercentageOverflowJobsExitCode0foursites = 0
-    else:
-        PercentageOverflowJobsExitCode0foursites = float(100*NumOverflowJobsExitCode0foursites)/NumOverflowJobs4sites
-    #print str(PercentageOverflowJobsExitCode0foursites)+"%"
-    if (NumOverflowJobsExitCode0foursites == 0):
-        WallDurationOverflowJobsExitCode0foursites = 0
-    else:
-        WallDurationOverflowJobsExitCode0foursites = int(row[1])
-
-    # Compute the percentage of walltime of overflow jobs with exit code 0 OVERFLOW the walltime of all overflow jobs (in 4 sites)
-    if (WallDurationOverflowJobs4sites == 0):
-        PercentageWallDurationOverflowJobsExitCode0foursites = 0
-    else:
-        PercentageWallDurationOverflowJobsExitCode0foursites = float(100*WallDurationOverflowJobsExitCode0foursites)/WallDurationOverflowJobs4sites
+    AddRowToJobStatistics(statistics["FourSites"]["Overflow"], ["NumExitCode0", "WallDurationExitCode0"], row)
 
     # Compute the number of normal jobs with exit code 0 (in 4 sites)
     querystring = """
@@ -500,143 +991,1578 @@ def QueryGratia(cursor):
     from JobUsageRecord JUR 
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
     JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
     where
       EndTime>=%s and EndTime<%s
       AND RESC.value = 0
       AND HostDescription NOT like '%%-overflow'
       AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
+      AND """ + foursites + """
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
     row = cursor.fetchone()
-    NumNormalJobsExitCode0foursites = int(row[0])
-
-    # Compute the percentage of number of normal jobs with exit code 0 OVER number of normal jobs (in 4 sites)
-    if (NumNormalJobs4sites == 0):
-        PercentageNormalJobsExitCode0foursites = 0
-    else:
-        PercentageNormalJobsExitCode0foursites = float(100*NumNormalJobsExitCode0foursites)/NumNormalJobs4sites
-    #print str(PercentageNormalJobsExitCode0foursites)+"%"
+    AddRowToJobStatistics(statistics["FourSites"]["Normal"], ["NumExitCode0"], row)
 
-    # Compute number of overflow jobs with exit code 84 (in 4 sites)
+    # Compute number (walltime) of overflow jobs with exit code 84 (in 4 sites)
     querystring = """
     SELECT
         COUNT(*), SUM(WallDuration)
     from JobUsageRecord JUR 
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
     JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
     where
       EndTime>=%s and EndTime<%s
       AND RESC.value = 84
       AND HostDescription like '%%-overflow'
       AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
+      AND """ + foursites + """
       AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
      """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
     row = cursor.fetchone()
-    NumOverflowJobsExitCode84foursites = int(row[0])
-
-    # Compute percentage of number of overflow jobs with exit code 84 OVER number of overflow jobs (in 4 sites)
-    PercentageOverflowJobsExitCode84foursites = float(100*NumOverflowJobsExitCode84foursites)/NumOverflowJobs4sites
-    #print str(PercentageOverflowJobsExitCode84foursites)+"%"
+    AddRowToJobStatistics(statistics["FourSites"]["Overflow"], ["NumExitCode84", "WallDurationExitCode84"], row)
 
-    if (NumOverflowJobsExitCode84foursites == 0):
-        WallDurationOverflowJobsExitCode84foursites = 0
-    else:
-        WallDurationOverflowJobsExitCode84foursites = float(row[1])
-
-    # Compute the percentage of walltime of overflow jobs with exit code 84 OVER walltime of overflow jobs (in 4 sites) 
-    if (WallDurationOverflowJobs4sites == 0):
-        PercentageWallDurationOverflowJobsExitCode84foursites  = 0
+    # Compute number of normal jobs with exit code 84 (in 4 sites)
+    querystring = """
+    SELECT
+        COUNT(*)
+    from JobUsageRecord JUR 
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    where
+      EndTime>=%s and EndTime<%s
+      AND RESC.value = 84
+      AND HostDescription NOT like '%%-overflow'
+      AND ResourceType="BatchPilot"
+      AND """ + foursites + """
+      AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
+     """
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
+    row = cursor.fetchone()
+    AddRowToJobStatistics(statistics["FourSites"]["Normal"], ["NumExitCode84"], row)
+
+    # Compute the number of overflow jobs whose efficiency greater than 80% (in 4 sites)
+    querystring = """
+    SELECT
+        COUNT(*)
+    from JobUsageRecord JUR 
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s and EndTime<%s
+      AND HostDescription like '%%-overflow'
+      AND ResourceType="BatchPilot"
+      AND """ + foursites + """
+      AND (CpuUserDuration+CpuSystemDuration)/WallDuration>0.8
+      AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
+     """
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
+    row = cursor.fetchone()
+    AddRowToJobStatistics(statistics["FourSites"]["Overflow"], ["NumEfficiencyGT80percent"], row)
+
+    # Compute the number of normal jobs whose efficiency greater than 80% (in 4 sites)
+    querystring = """
+    SELECT
+        COUNT(*)
+    from JobUsageRecord JUR 
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s and EndTime<%s
+      AND HostDescription NOT like '%%-overflow'
+      AND ResourceType="BatchPilot"
+      AND """ + foursites + """
+      AND (CpuUserDuration+CpuSystemDuration)/WallDuration>0.8
+      AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
+     """
+    cursor.execute(querystring, (EarliestEndTime, LatestEndTime) + foursitesparameters)
+    row = cursor.fetchone()
+    AddRowToJobStatistics(statistics["FourSites"]["Normal"], ["NumEfficiencyGT80percent"], row)
+
+    return statistics
+
+
+'''
+Conditions for the single scan.  Each population of the report is one
+CASE condition; the 4 sites additionally need their site group (see
+FourSitesLikeCondition) and the Probe/Site join to succeed, which the
+per-query strategy checks in ResolveFourSites and we get from a LEFT
+JOIN (probename is unique in Probe, so the LEFT JOIN does not duplicate
+rows).  None stands for the 4-site condition alone.
+'''
+OverflowCondition = "HostDescription like '%%-overflow'"
+NormalCondition = "HostDescription NOT like '%%-overflow'"
+
+SingleScanPopulations = [
+    ("AllSites", "Overflow", OverflowCondition),
+    ("AllSites", "Normal", NormalCondition),
+    ("FourSites", "All", None),
+    ("FourSites", "Overflow", OverflowCondition),
+    ("FourSites", "Normal", NormalCondition),
+    ]
+
+# job statistics key -> (value summed, extra condition)
+SingleScanAggregates = [
+    ("Num", "1", None),
+    ("WallDuration", "WallDuration", None),
+    ("UserAndSystemDuration", "CpuUserDuration+CpuSystemDuration", None),
+    ("NumExitCode0", "1", "RESC.value = 0"),
+    ("WallDurationExitCode0", "WallDuration", "RESC.value = 0"),
+    ("NumExitCode84", "1", "RESC.value = 84"),
+    ("WallDurationExitCode84", "WallDuration", "RESC.value = 84"),
+    ("NumEfficiencyGT80percent", "1", "(CpuUserDuration+CpuSystemDuration)/WallDuration > 0.8"),
+    ]
+
+def BuildSingleScanQuery():
+    '''
+    Build the SUM(CASE ...) query of the single scan strategy, and return it
+    together with the (site group, population, key) of each selected column
+    and the parameters of the 4-site conditions.  The rows are grouped by
+    efficiency bin (the first column), which is computed once per job; the
+    Num and WallDuration of a group are its bin's, see QueryGratiaSingleScan.
+    '''
+    columns = []
+    expressions = []
+    parameters = []
+    foursites, foursitesparameters = FourSitesLikeCondition()
+    for sitegroup, population, condition in SingleScanPopulations:
+        conditionparameters = ()
+        if sitegroup == "FourSites":
+            conditionparameters = foursitesparameters
+            if condition:
+                condition = foursites + " AND S.siteid IS NOT NULL AND " + condition
+            else:
+                condition = foursites + " AND S.siteid IS NOT NULL"
+        for key, value, extracondition in SingleScanAggregates:
+            if extracondition:
+                fullcondition = condition + " AND " + extracondition
+            else:
+                fullcondition = condition
+            expressions.append("SUM(CASE WHEN " + fullcondition + " THEN " + value + " ELSE 0 END)")
+            columns.append((sitegroup, population, key))
+            parameters.extend(conditionparameters)
+    querystring = """
+    SELECT
+        """ + EfficiencyBinExpression() + """ AS EfficiencyBin,
+        """ + ",\n        ".join(expressions) + """
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    LEFT JOIN Probe P on (JURM.ProbeName = P.probename)
+    LEFT JOIN Site S on (P.siteid = S.siteid)
+    where
+      EndTime>=%s and EndTime<%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s
+    GROUP BY EfficiencyBin
+     """
+    return querystring, columns, tuple(parameters)
+
+
+def QueryGratiaSingleScan(cursor):
+    '''
+    Fetch the report aggregates with a single SELECT, so that the window
+    is scanned (and JobUsageRecord, Resource and JobUsageRecord_Meta are
+    joined) only once
+    '''
+    statistics = NewReportStatistics()
+    querystring, columns, parameters = BuildSingleScanQuery()
+    cursor.execute(querystring, parameters + (EarliestEndTime, LatestEndTime, GlideinProbeName))
+    for row in cursor.fetchall():
+        efficiencybin = row[0]
+        for (sitegroup, population, key), value in zip(columns, row[1:]):
+            AddRowToJobStatistics(statistics[sitegroup][population], [key], [value])
+            if efficiencybin is not None and key in ("Num", "WallDuration"):
+                numkey, walldurationkey = EfficiencyBinKeys(int(efficiencybin))
+                binkey = {"Num": numkey, "WallDuration": walldurationkey}[key]
+                AddRowToJobStatistics(statistics[sitegroup][population], [binkey], [value])
+    return statistics
+
+
+# HostDescription -> (overflow, normal, foursites), see ClassifyHostDescription
+hostDescriptionClassDictionary = {}
+
+def ClassifyHostDescription(hostdescription):
+    '''
+    Return (overflow, normal, foursites) for one HostDescription, giving
+    the same answers as the LIKE conditions of the queries: the match is
+    case-insensitive, and NULL matches neither LIKE nor NOT LIKE.
+    There are only a few hundred HostDescription, so answers are memoized.
+    '''
+    classes = hostDescriptionClassDictionary.get(hostdescription, None)
+    if classes:
+        return classes
+    if hostdescription is None:
+        classes = (False, False, False)
+    else:
+        lowered = hostdescription.lower()
+        overflow = lowered.endswith("-overflow")
+        classes = (overflow, not overflow, MatchesFourSites(hostdescription))
+    hostDescriptionClassDictionary[hostdescription] = classes
+    return classes
+
+
+def ProbeHasSite(cursor, probename):
+    '''
+    Whether the probe joins to a Probe and a Site row, which the 4-site
+    queries require
+    '''
+    querystring = """
+    SELECT
+        COUNT(*)
+    from Probe P
+    JOIN Site S on (P.siteid = S.siteid)
+    where
+      P.probename=%s
+     """
+    cursor.execute(querystring, (probename,))
+    row = cursor.fetchone()
+    return int(row[0]) > 0
+
+
+def FetchJobColumns(cursor, earliest, latest, probename):
+    '''
+    Fetch the narrow projection the client-side strategies work on, one
+    row per job in the window, and return it column by column
+    key                    value
+    dbid                   numpy array of JobUsageRecord.dbid
+    HostDescriptionCode    numpy array of indexes into HostDescriptions
+    HostDescriptions       list of the distinct HostDescription (may hold None)
+    ExitCode               numpy array of the ExitCode value (NaN for NULL)
+    WallDuration           numpy array (NaN for NULL)
+    UserAndSystemDuration  numpy array of CpuUserDuration+CpuSystemDuration
+    The ExitCode comes back as RESC.value+0 so that MySQL converts the
+    string exactly as it does for "RESC.value = 84".
+    '''
+    querystring = """
+    SELECT
+        JUR.dbid, HostDescription, RESC.value+0, WallDuration, CpuUserDuration+CpuSystemDuration
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s and EndTime<%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s
+     """
+    cursor.execute(querystring, (earliest, latest, probename))
+    return BuildJobColumns(cursor.fetchall())
+
+
+def BuildJobColumns(rows, withendtime=False):
+    '''
+    Turn (dbid, HostDescription, ExitCode, WallDuration, UserAndSystemDuration)
+    rows into the columns described in FetchJobColumns.  With withendtime,
+    rows carry a sixth EndTime (UTC datetime) field, kept as an EndTime
+    column of epoch seconds.
+    '''
+    if withendtime:
+        width = 6
+    else:
+        width = 5
+    # one object array for the whole result, then one conversion per
+    # column; None (NULL) becomes NaN in the float columns
+    table = numpy.array(rows, dtype=object).reshape(len(rows), width)
+    hostdescriptions = table[:, 1]
+    # there are only a few hundred distinct HostDescription, so we keep
+    # them once and give every row the index of its own
+    distinct = list(set(hostdescriptions))
+    codes = dict(zip(distinct, range(len(distinct))))
+    columns = {}
+    columns["dbid"] = table[:, 0].astype(numpy.int64)
+    columns["HostDescriptionCode"] = numpy.fromiter(itertools.imap(codes.__getitem__, hostdescriptions), dtype=numpy.int32, count=len(hostdescriptions))
+    columns["HostDescriptions"] = distinct
+    columns["ExitCode"] = table[:, 2].astype(numpy.float64)
+    columns["WallDuration"] = table[:, 3].astype(numpy.float64)
+    columns["UserAndSystemDuration"] = table[:, 4].astype(numpy.float64)
+    if withendtime:
+        columns["EndTime"] = numpy.array([calendar.timegm(endtime.utctimetuple()) for endtime in table[:, 5]], dtype=numpy.int64)
+    return columns
+
+
+def SelectJobColumns(columns, mask):
+    '''
+    Return the columns of the jobs selected by the boolean array mask
+    '''
+    selected = {}
+    for key, value in columns.iteritems():
+        if key == "HostDescriptions":
+            selected[key] = value
+        else:
+            selected[key] = value[mask]
+    return selected
+
+
+def ConcatenateJobColumns(columnslist, withendtime=False):
+    '''
+    Put several sets of columns end to end, merging their HostDescriptions
+    and recoding HostDescriptionCode accordingly
+    '''
+    if not columnslist:
+        return BuildJobColumns((), withendtime)
+    codes = {}
+    recoded = []
+    for columns in columnslist:
+        mapping = numpy.array([codes.setdefault(hostdescription, len(codes)) for hostdescription in columns["HostDescriptions"]], dtype=numpy.int32)
+        recoded.append(mapping[columns["HostDescriptionCode"]])
+    distinct = [None] * len(codes)
+    for hostdescription, code in codes.iteritems():
+        distinct[code] = hostdescription
+    concatenated = {}
+    for key in columnslist[0]:
+        if key not in ["HostDescriptions", "HostDescriptionCode"]:
+            concatenated[key] = numpy.concatenate([columns[key] for columns in columnslist])
+    concatenated["HostDescriptionCode"] = numpy.concatenate(recoded)
+    concatenated["HostDescriptions"] = distinct
+    return concatenated
+
+
+def ColumnarJobStatistics(columns, mask, flags):
+    '''
+    Compute the aggregates of the jobs selected by the boolean array mask.
+    flags holds the per-job exit code 0, exit code 84, efficiency > 80%
+    and efficiency bin arrays, which are the same for every population.
+    SUM() skips NULL durations, so do we (nansum).
+    '''
+    statistics = NewJobStatistics()
+    wallduration = columns["WallDuration"]
+    statistics["Num"] = int(numpy.count_nonzero(mask))
+    statistics["WallDuration"] = float(numpy.nansum(wallduration[mask]))
+    statistics["UserAndSystemDuration"] = float(numpy.nansum(columns["UserAndSystemDuration"][mask]))
+    exitcode0 = mask & flags["ExitCode0"]
+    statistics["NumExitCode0"] = int(numpy.count_nonzero(exitcode0))
+    statistics["WallDurationExitCode0"] = float(numpy.nansum(wallduration[exitcode0]))
+    exitcode84 = mask & flags["ExitCode84"]
+    statistics["NumExitCode84"] = int(numpy.count_nonzero(exitcode84))
+    statistics["WallDurationExitCode84"] = float(numpy.nansum(wallduration[exitcode84]))
+    statistics["NumEfficiencyGT80percent"] = int(numpy.count_nonzero(mask & flags["EfficiencyGT80percent"]))
+    efficiencybins = flags["EfficiencyBin"][mask]
+    binnedwallduration = numpy.where(numpy.isnan(wallduration[mask]), 0.0, wallduration[mask])
+    nums = numpy.bincount(efficiencybins, minlength=EfficiencyBins + 1)
+    walldurations = numpy.bincount(efficiencybins, binnedwallduration, minlength=EfficiencyBins + 1)
+    for efficiencybin in range(EfficiencyBins):
+        numkey, walldurationkey = EfficiencyBinKeys(efficiencybin)
+        statistics[numkey] = int(nums[efficiencybin])
+        statistics[walldurationkey] = float(walldurations[efficiencybin])
+    return statistics
+
+
+def ColumnarReportStatistics(columns, probehassite):
+    '''
+    Compute the report aggregates from the columns of FetchJobColumns.
+    Classification is done once per distinct HostDescription, and then
+    spread to the jobs by indexing with HostDescriptionCode.
+    '''
+    classes = [ClassifyHostDescription(hostdescription) for hostdescription in columns["HostDescriptions"]]
+    isoverflow = numpy.array([c[0] for c in classes], dtype=bool)
+    isnormal = numpy.array([c[1] for c in classes], dtype=bool)
+    isfoursites = numpy.array([c[2] and probehassite for c in classes], dtype=bool)
+    code = columns["HostDescriptionCode"]
+    overflow = isoverflow[code]
+    normal = isnormal[code]
+    foursites = isfoursites[code]
+
+    # comparisons with NaN (NULL) are false, as in SQL; a zero walltime
+    # gives NULL in MySQL, so it never counts as efficient
+    exitcode = columns["ExitCode"]
+    wallduration = columns["WallDuration"]
+    flags = {}
+    olderr = numpy.seterr(divide="ignore", invalid="ignore")
+    try:
+        flags["ExitCode0"] = (exitcode == 0)
+        flags["ExitCode84"] = (exitcode == 84)
+        efficiency = columns["UserAndSystemDuration"] / wallduration
+        flags["EfficiencyGT80percent"] = (efficiency > 0.8) & (wallduration != 0)
+        # jobs without an efficiency go to an extra bin EfficiencyBins
+        # that is never reported
+        efficiencybin = numpy.searchsorted(numpy.array(EfficiencyBinEdges), efficiency, "left")
+        efficiencybin[numpy.isnan(efficiency) | (wallduration == 0)] = EfficiencyBins
+        flags["EfficiencyBin"] = efficiencybin
+    finally:
+        numpy.seterr(**olderr)
+
+    statistics = NewReportStatistics()
+    statistics["AllSites"]["Overflow"] = ColumnarJobStatistics(columns, overflow, flags)
+    statistics["AllSites"]["Normal"] = ColumnarJobStatistics(columns, normal, flags)
+    statistics["FourSites"]["All"] = ColumnarJobStatistics(columns, foursites, flags)
+    statistics["FourSites"]["Overflow"] = ColumnarJobStatistics(columns, foursites & overflow, flags)
+    statistics["FourSites"]["Normal"] = ColumnarJobStatistics(columns, foursites & normal, flags)
+    return statistics
+
+
+'''
+Local cache of the columnar extracts, so that rerunning a report (or
+reporting on an old window) does not go back to gratia.  One compressed
+numpy archive per (probe, EarliestEndTime, LatestEndTime); the least
+recently used archives are removed once the cache grows past its size.
+main sets these from the command line; no directory means no cache.
+'''
+JobColumnsCacheDirectory = None
+JobColumnsCacheMaxBytes = 1024 * 1024 * 1024
+
+def JobColumnsCachePath(cachedirectory, probename, earliest, latest):
+    '''
+    Return the cache file of one window
+    '''
+    filename = "%s_%s_%s.npz" % (re.sub("[^A-Za-z0-9.-]", "_", probename),
+                                 earliest.strftime("%Y%m%dT%H%M%S"),
+                                 latest.strftime("%Y%m%dT%H%M%S"))
+    return os.path.join(cachedirectory, filename)
+
+
+def SaveJobColumns(path, columns, probehassite=None):
+    '''
+    Write a set of columns to a compressed archive.  numpy cannot store
+    None in a string array, so NULL HostDescription are kept in a separate
+    flag array.  The archive is written under a temporary name and
+    renamed, so readers never see half a file.
+    '''
+    arrays = {}
+    for key, value in columns.iteritems():
+        if key != "HostDescriptions":
+            arrays[key] = value
+    hostdescriptions = columns["HostDescriptions"]
+    arrays["HostDescriptions"] = numpy.array([hostdescription or "" for hostdescription in hostdescriptions])
+    arrays["HostDescriptionIsNull"] = numpy.array([hostdescription is None for hostdescription in hostdescriptions], dtype=bool)
+    if probehassite is not None:
+        arrays["ProbeHasSite"] = numpy.array(probehassite, dtype=bool)
+    temporarypath = "%s.%d.tmp" % (path, os.getpid())
+    outfile = open(temporarypath, "wb")
+    try:
+        numpy.savez_compressed(outfile, **arrays)
+    finally:
+        outfile.close()
+    os.rename(temporarypath, path)
+
+
+def LoadJobColumns(path):
+    '''
+    Read an archive written by SaveJobColumns, and return the columns and
+    whether the probe has a site (None when it was not saved).  Touch the
+    file so that cache eviction sees it as recently used.
+    '''
+    archive = numpy.load(path)
+    try:
+        columns = {}
+        for key in archive.files:
+            if key not in ["HostDescriptions", "HostDescriptionIsNull", "ProbeHasSite"]:
+                columns[key] = archive[key]
+        hostdescriptions = archive["HostDescriptions"].tolist()
+        for index, isnull in enumerate(archive["HostDescriptionIsNull"].tolist()):
+            if isnull:
+                hostdescriptions[index] = None
+        columns["HostDescriptions"] = hostdescriptions
+        if "ProbeHasSite" in archive.files:
+            probehassite = bool(archive["ProbeHasSite"])
+        else:
+            probehassite = None
+    finally:
+        archive.close()
+    os.utime(path, None)
+    return columns, probehassite
+
+
+def EvictJobColumnsCache(cachedirectory, maxbytes, keeppath=None):
+    '''
+    Remove the least recently used archives until the cache fits in
+    maxbytes.  keeppath (the archive just written) is never removed.
+    '''
+    entries = []
+    totalbytes = 0
+    for filename in os.listdir(cachedirectory):
+        if not filename.endswith(".npz"):
+            continue
+        path = os.path.join(cachedirectory, filename)
+        status = os.stat(path)
+        entries.append((status.st_mtime, path, status.st_size))
+        totalbytes += status.st_size
+    entries.sort()
+    for mtime, path, size in entries:
+        if totalbytes <= maxbytes:
+            break
+        if path == keeppath:
+            continue
+        os.remove(path)
+        totalbytes -= size
+
+
+def InvalidateJobColumnsCache(cachedirectory, probename=None, earliest=None, latest=None):
+    '''
+    Remove the archive of one window, or every archive when no window is given
+    '''
+    if not os.path.isdir(cachedirectory):
+        return
+    if probename is not None:
+        path = JobColumnsCachePath(cachedirectory, probename, earliest, latest)
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    for filename in os.listdir(cachedirectory):
+        if filename.endswith(".npz"):
+            os.remove(os.path.join(cachedirectory, filename))
+
+
+def CachedFetchJobColumns(cursor, earliest, latest, probename):
+    '''
+    FetchJobColumns and ProbeHasSite, going through the local cache when
+    there is one
+    '''
+    if JobColumnsCacheDirectory is None:
+        return FetchJobColumns(cursor, earliest, latest, probename), ProbeHasSite(cursor, probename)
+    path = JobColumnsCachePath(JobColumnsCacheDirectory, probename, earliest, latest)
+    if os.path.exists(path):
+        return LoadJobColumns(path)
+    columns = FetchJobColumns(cursor, earliest, latest, probename)
+    probehassite = ProbeHasSite(cursor, probename)
+    if not os.path.isdir(JobColumnsCacheDirectory):
+        os.makedirs(JobColumnsCacheDirectory)
+    SaveJobColumns(path, columns, probehassite)
+    EvictJobColumnsCache(JobColumnsCacheDirectory, JobColumnsCacheMaxBytes, path)
+    return columns, probehassite
+
+
+def QueryGratiaColumnar(cursor):
+    '''
+    Fetch the narrow per-job projection once (or read it from the local
+    cache), and compute the report aggregates in memory with numpy,
+    keeping the work off the gratia server
+    '''
+    if numpy is None:
+        raise ImportError("the columnar strategy needs numpy")
+    columns, probehassite = CachedFetchJobColumns(cursor, EarliestEndTime, LatestEndTime, GlideinProbeName)
+    return ColumnarReportStatistics(columns, probehassite)
+
+
+'''
+Client-side join.  Resource holds one row per (dbid, description), so
+it is by far the largest table, and every query above makes the server
+join it row by row.  The hashjoin strategy instead reads the job
+projection without Resource, then reads (dbid, ExitCode) for the whole
+dbid range of those jobs in one pass over the Resource primary key, and
+joins the two in memory.  The range also holds the records of other
+probes and resource types, which are read and dropped.
+'''
+def FetchJobProjection(cursor, earliest, latest, probename):
+    '''
+    Fetch the columns of FetchJobColumns without joining Resource (the
+    ExitCode column is all NaN)
+    '''
+    querystring = """
+    SELECT
+        JUR.dbid, HostDescription, NULL, WallDuration, CpuUserDuration+CpuSystemDuration
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    where
+      EndTime>=%s and EndTime<%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s
+     """
+    cursor.execute(querystring, (earliest, latest, probename))
+    return BuildJobColumns(cursor.fetchall())
+
+
+def FetchExitCodes(cursor, lowdbid, highdbid):
+    '''
+    Return the dbid and ExitCode (RESC.value+0, NaN for NULL) of every
+    ExitCode row in [lowdbid, highdbid], as two numpy arrays sorted by dbid
+    '''
+    querystring = """
+    SELECT
+        RESC.dbid, RESC.value+0
+    from Resource RESC
+    where
+      RESC.dbid>=%s and RESC.dbid<=%s
+      AND RESC.description="ExitCode"
+     """
+    cursor.execute(querystring, (lowdbid, highdbid))
+    table = numpy.array(cursor.fetchall(), dtype=object).reshape(-1, 2)
+    dbids = table[:, 0].astype(numpy.int64)
+    exitcodes = table[:, 1].astype(numpy.float64)
+    order = numpy.argsort(dbids, kind="mergesort")
+    return dbids[order], exitcodes[order]
+
+
+def JoinExitCodes(columns, dbids, exitcodes):
+    '''
+    Inner join the job columns with sorted (dbid, ExitCode) arrays, as the
+    JOIN on Resource does: jobs without an ExitCode are dropped, and a
+    job with several ExitCode rows is counted once for each
+    '''
+    first = numpy.searchsorted(dbids, columns["dbid"], "left")
+    last = numpy.searchsorted(dbids, columns["dbid"], "right")
+    matches = last - first
+    if (matches == 1).all():
+        joined = dict(columns)
+        joined["ExitCode"] = exitcodes[first]
+        return joined
+    # repeat each job once per match, and walk its matches in order
+    jobs = numpy.repeat(numpy.arange(len(matches)), matches)
+    offsets = numpy.arange(len(jobs)) - numpy.repeat(numpy.cumsum(matches) - matches, matches)
+    joined = SelectJobColumns(columns, jobs)
+    joined["ExitCode"] = exitcodes[numpy.repeat(first, matches) + offsets]
+    return joined
+
+
+def QueryGratiaHashJoin(cursor):
+    '''
+    Compute the report aggregates like the columnar strategy, joining
+    Resource on the client instead of the server
+    '''
+    if numpy is None:
+        raise ImportError("the hashjoin strategy needs numpy")
+    columns = FetchJobProjection(cursor, EarliestEndTime, LatestEndTime, GlideinProbeName)
+    if len(columns["dbid"]):
+        dbids, exitcodes = FetchExitCodes(cursor, int(columns["dbid"].min()), int(columns["dbid"].max()))
+        columns = JoinExitCodes(columns, dbids, exitcodes)
+    return ColumnarReportStatistics(columns, ProbeHasSite(cursor, GlideinProbeName))
+
+
+def BenchmarkStrategies(cursor, strategies, repeat=3):
+    '''
+    Time each strategy (the best of repeat runs) and print the timings,
+    checking that it prints the same report as the first one (some
+    strategies leave the aggregates the report does not use at 0)
+    '''
+    timings = []
+    reports = []
+    for strategy in strategies:
+        best = None
+        for attempt in range(repeat):
+            start = time.time()
+            statistics = QueryGratiaStrategies[strategy](cursor)
+            elapsed = time.time() - start
+            if best is None or elapsed < best:
+                best = elapsed
+        timings.append(best)
+        output = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            PrintReport(statistics)
+            reports.append(sys.stdout.getvalue())
+        finally:
+            sys.stdout = output
+    print "\nStrategy timings (best of %d)\n" % repeat
+    for strategy, best, report in zip(strategies, timings, reports):
+        if report == reports[0]:
+            print "%-12s %8.3fs" % (strategy, best)
+        else:
+            print "%-12s %8.3fs (report differs from %s)" % (strategy, best, strategies[0])
+
+
+'''
+Keyset pagination.  Instead of one result set for a whole window, which
+client and server both buffer, a query is walked in pages ordered by
+JUR.dbid: each page asks for the next pagesize rows above the last dbid
+seen (no OFFSET, so every page is a primary key range scan), bounded by
+the dbid range of the window.  Memory is set by the page size, not by
+the window.  main sets the page size from the command line.
+'''
+KeysetPageSize = 10000
+
+def WindowDbidRange(cursor, earliest, latest):
+    '''
+    Return the lowest and highest dbid of the jobs ending in
+    [earliest, latest), or None if there are none
+    '''
+    querystring = """
+    SELECT
+        MIN(dbid), MAX(dbid)
+    from JobUsageRecord
+    where
+      EndTime>=%s and EndTime<%s
+     """
+    cursor.execute(querystring, (earliest, latest))
+    lowdbid, highdbid = cursor.fetchone()
+    if lowdbid is None:
+        return None
+    return int(lowdbid), int(highdbid)
+
+
+def KeysetPages(cursor, querystring, parameters, earliest, latest, pagesize):
+    '''
+    Yield the rows of querystring over [earliest, latest) one page (a list
+    of at most pagesize rows) at a time.  querystring must select JUR.dbid
+    first and end with its where clause, which must restrict EndTime to
+    the window; parameters are its own parameters.
+    A job may have several rows (two ExitCode rows, say), and LIMIT can
+    cut a page between them, so the last job of a full page is always
+    fetched whole before the next page starts above its dbid.
+    '''
+    dbidrange = WindowDbidRange(cursor, earliest, latest)
+    if dbidrange is None:
+        return
+    lastdbid, highdbid = dbidrange[0] - 1, dbidrange[1]
+    pagequerystring = querystring + """
+      AND JUR.dbid>%s AND JUR.dbid<=%s
+    ORDER BY JUR.dbid
+    LIMIT %s
+     """
+    lastjobquerystring = querystring + """
+      AND JUR.dbid=%s
+     """
+    while 1:
+        cursor.execute(pagequerystring, tuple(parameters) + (lastdbid, highdbid, pagesize))
+        rows = list(cursor.fetchall())
+        # LIMIT only stops early when the page is full
+        full = len(rows) >= pagesize
+        if full:
+            lastdbid = int(rows[-1][0])
+            cursor.execute(lastjobquerystring, tuple(parameters) + (lastdbid,))
+            rows = [row for row in rows if int(row[0]) != lastdbid] + list(cursor.fetchall())
+        if rows:
+            yield rows
+        if not full:
+            break
+
+
+def QueryGratiaPaged(cursor):
+    '''
+    Compute the report aggregates like the columnar strategy, one keyset
+    page of jobs at a time
+    '''
+    if numpy is None:
+        raise ImportError("the paged strategy needs numpy")
+    querystring = """
+    SELECT
+        JUR.dbid, HostDescription, RESC.value+0, WallDuration, CpuUserDuration+CpuSystemDuration
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s and EndTime<%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s"""
+    probehassite = ProbeHasSite(cursor, GlideinProbeName)
+    statistics = NewReportStatistics()
+    for rows in KeysetPages(cursor, querystring, (EarliestEndTime, LatestEndTime, GlideinProbeName),
+                            EarliestEndTime, LatestEndTime, KeysetPageSize):
+        MergeReportStatistics(statistics, ColumnarReportStatistics(BuildJobColumns(rows), probehassite))
+    return statistics
+
+
+'''
+Incremental ingestion.  JobUsageRecord.dbid only grows, so instead of
+reading the whole window every time we remember the highest dbid seen
+(the high-water mark), fetch only the records above it, and append them
+to a local store with one directory per UTC day of EndTime:
+    <store>/<probe>/highwater
+    <store>/<probe>/<YYYYMMDD>/<first dbid>-<last dbid>.npz
+The report is then computed from the days its window overlaps.  Records
+that gratia deletes or merges after we ingested them stay in the store.
+main sets the directory from the command line.
+
+MySQL hands out auto-increment dbids before the inserting transactions
+commit, so a record can become visible after one with a higher dbid.
+The last IncrementalOverlapDbids dbids read are therefore not settled:
+the mark is kept that far behind MAX(dbid), they are stored in chunks of
+their own, and the next run removes those chunks and reads them again.
+'''
+IncrementalStoreDirectory = None
+IncrementalOverlapDbids = 10000
+
+def IncrementalProbeDirectory(storedirectory, probename):
+    '''
+    Return the store directory of one probe
+    '''
+    return os.path.join(storedirectory, re.sub("[^A-Za-z0-9.-]", "_", probename))
+
+
+def ReadHighWaterMark(probedirectory):
+    '''
+    Return the dbid up to which the store is settled, or None before the
+    first run
+    '''
+    path = os.path.join(probedirectory, "highwater")
+    if not os.path.exists(path):
+        return None
+    infile = open(path)
+    try:
+        return int(infile.read().strip())
+    finally:
+        infile.close()
+
+
+def WriteHighWaterMark(probedirectory, dbid):
+    '''
+    Record the dbid up to which the store is settled (written then
+    renamed, like the archives)
+    '''
+    path = os.path.join(probedirectory, "highwater")
+    temporarypath = "%s.%d.tmp" % (path, os.getpid())
+    outfile = open(temporarypath, "w")
+    try:
+        outfile.write("%d\n" % dbid)
+    finally:
+        outfile.close()
+    os.rename(temporarypath, path)
+
+
+def FetchNewJobColumns(cursor, lowdbid, highdbid, earliest, probename):
+    '''
+    Fetch the columns (with EndTime) of the jobs with lowdbid < dbid <= highdbid.
+    Before the first run there is no lowdbid, and we start from the jobs
+    ending after earliest instead.
+    '''
+    if lowdbid is None:
+        querystring = """
+    SELECT
+        JUR.dbid, HostDescription, RESC.value+0, WallDuration, CpuUserDuration+CpuSystemDuration, EndTime
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s AND JUR.dbid<=%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s
+     """
+        cursor.execute(querystring, (earliest, highdbid, probename))
+    else:
+        querystring = """
+    SELECT
+        JUR.dbid, HostDescription, RESC.value+0, WallDuration, CpuUserDuration+CpuSystemDuration, EndTime
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      JUR.dbid>%s AND JUR.dbid<=%s
+      AND EndTime IS NOT NULL
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s
+     """
+        cursor.execute(querystring, (lowdbid, highdbid, probename))
+    return BuildJobColumns(cursor.fetchall(), True)
+
+
+def RemoveUnsettledChunks(probedirectory, settleddbid):
+    '''
+    Remove the chunk files of the store above the settled dbid (their
+    first dbid is greater), which are read again
+    '''
+    for dayname in os.listdir(probedirectory):
+        daydirectory = os.path.join(probedirectory, dayname)
+        if not os.path.isdir(daydirectory):
+            continue
+        for filename in os.listdir(daydirectory):
+            if filename.endswith(".npz") and int(filename.split("-")[0]) > settleddbid:
+                os.remove(os.path.join(daydirectory, filename))
+
+
+def IngestNewJobs(cursor, storedirectory, probename, earliest):
+    '''
+    Append the jobs gratia received since the last run to the store, and
+    move the high-water mark.  The upper dbid is fixed before fetching, so
+    records inserted meanwhile are left for the next run.  Everything
+    above the mark (the unsettled dbids of the last run, or the chunks
+    of a run that died) is removed and read again, the jobs up to
+    IncrementalOverlapDbids below MAX(dbid) are stored as settled and
+    the rest in separate chunks, and the mark is written last.
+    Return the number of jobs read.
+    '''
+    probedirectory = IncrementalProbeDirectory(storedirectory, probename)
+    if not os.path.isdir(probedirectory):
+        os.makedirs(probedirectory)
+    lowdbid = ReadHighWaterMark(probedirectory)
+    cursor.execute("SELECT MAX(dbid) from JobUsageRecord")
+    row = cursor.fetchone()
+    highdbid = int(row[0] or 0)
+    if lowdbid is not None and highdbid <= lowdbid:
+        return 0
+    RemoveUnsettledChunks(probedirectory, lowdbid or 0)
+    columns = FetchNewJobColumns(cursor, lowdbid, highdbid, earliest, probename)
+    settleddbid = max(lowdbid or 0, highdbid - IncrementalOverlapDbids)
+    days = columns["EndTime"] // 86400
+    settled = columns["dbid"] <= settleddbid
+    for day in numpy.unique(days):
+        daydirectory = os.path.join(probedirectory, datetime.utcfromtimestamp(int(day) * 86400).strftime("%Y%m%d"))
+        if not os.path.isdir(daydirectory):
+            os.mkdir(daydirectory)
+        for firstdbid, lastdbid, selection in [((lowdbid or 0) + 1, settleddbid, settled),
+                                               (settleddbid + 1, highdbid, ~settled)]:
+            selection = selection & (days == day)
+            if selection.any():
+                chunkpath = os.path.join(daydirectory, "%d-%d.npz" % (firstdbid, lastdbid))
+                SaveJobColumns(chunkpath, SelectJobColumns(columns, selection))
+    WriteHighWaterMark(probedirectory, settleddbid)
+    return len(columns["dbid"])
+
+
+def LoadStoredJobColumns(storedirectory, probename, earliest, latest):
+    '''
+    Return the columns of the stored jobs with earliest <= EndTime < latest
+    '''
+    probedirectory = IncrementalProbeDirectory(storedirectory, probename)
+    earliestepoch = calendar.timegm(earliest.timetuple())
+    latestepoch = calendar.timegm(latest.timetuple())
+    chunks = []
+    for day in range(earliestepoch // 86400, (latestepoch - 1) // 86400 + 1):
+        daydirectory = os.path.join(probedirectory, datetime.utcfromtimestamp(day * 86400).strftime("%Y%m%d"))
+        if not os.path.isdir(daydirectory):
+            continue
+        for filename in sorted(os.listdir(daydirectory)):
+            if filename.endswith(".npz"):
+                chunks.append(LoadJobColumns(os.path.join(daydirectory, filename))[0])
+    columns = ConcatenateJobColumns(chunks, True)
+    endtime = columns["EndTime"]
+    return SelectJobColumns(columns, (endtime >= earliestepoch) & (endtime < latestepoch))
+
+
+def QueryGratiaIncremental(cursor):
+    '''
+    Ingest the jobs gratia received since the last run into the local
+    store, and compute the report aggregates from the store
+    '''
+    if numpy is None:
+        raise ImportError("the incremental strategy needs numpy")
+    if IncrementalStoreDirectory is None:
+        raise ValueError("the incremental strategy needs a store directory")
+    IngestNewJobs(cursor, IncrementalStoreDirectory, GlideinProbeName, EarliestEndTime)
+    columns = LoadStoredJobColumns(IncrementalStoreDirectory, GlideinProbeName, EarliestEndTime, LatestEndTime)
+    return ColumnarReportStatistics(columns, ProbeHasSite(cursor, GlideinProbeName))
+
+
+def FetchGroupedJobStatistics(cursor, earliest, latest, probename):
+    '''
+    Ask gratia for partial sums per (HostDescription, ExitCode, efficiency
+    greater than 80%, efficiency bin).  This is some ten thousand rows,
+    whatever the number of jobs; the LIKE tests are left to
+    ClassifyHostDescription.
+    '''
+    return FetchGroupedJobStatisticsByProbe(cursor, earliest, latest, [probename]).get(probename, [])
+
+
+def FetchGroupedJobStatisticsByProbe(cursor, earliest, latest, probenames):
+    '''
+    Do FetchGroupedJobStatistics for several probes with one query, and
+    return a dictionary
+    key        value
+    ProbeName  list of (HostDescription, ExitCode, EfficiencyGT80percent,
+               EfficiencyBin, COUNT(*), SUM(WallDuration),
+               SUM(CpuUserDuration+CpuSystemDuration)) rows
+    '''
+    querystring = """
+    SELECT
+        JURM.ProbeName, HostDescription, RESC.value+0 AS ExitCodeValue,
+        (CpuUserDuration+CpuSystemDuration)/WallDuration > 0.8 AS EfficiencyGT80percent,
+        """ + EfficiencyBinExpression() + """ AS EfficiencyBin,
+        COUNT(*), SUM(WallDuration), SUM(CpuUserDuration+CpuSystemDuration)
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s and EndTime<%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName IN (""" + ", ".join(["%s"] * len(probenames)) + """)
+    GROUP BY JURM.ProbeName, HostDescription, ExitCodeValue, EfficiencyGT80percent, EfficiencyBin
+     """
+    cursor.execute(querystring, (earliest, latest) + tuple(probenames))
+    groups = {}
+    for row in cursor.fetchall():
+        groups.setdefault(row[0], []).append(tuple(row[1:]))
+    return groups
+
+
+def AddGroupToJobStatistics(statistics, exitcode, efficient, efficiencybin, row):
+    '''
+    Add the (COUNT(*), SUM(WallDuration), SUM(CpuUserDuration+CpuSystemDuration))
+    of one group to a set of aggregates
+    '''
+    AddRowToJobStatistics(statistics, ["Num", "WallDuration", "UserAndSystemDuration"], row)
+    if exitcode == 0:
+        AddRowToJobStatistics(statistics, ["NumExitCode0", "WallDurationExitCode0"], row)
+    if exitcode == 84:
+        AddRowToJobStatistics(statistics, ["NumExitCode84", "WallDurationExitCode84"], row)
+    if efficient:
+        AddRowToJobStatistics(statistics, ["NumEfficiencyGT80percent"], row)
+    if efficiencybin is not None:
+        AddRowToJobStatistics(statistics, EfficiencyBinKeys(int(efficiencybin)), row)
+
+
+def AddGroupToReportStatistics(statistics, overflow, normal, foursites, exitcode, efficient, efficiencybin, row):
+    '''
+    Add the partial sums of one group of jobs to every population of the
+    report it belongs to
+    '''
+    populations = []
+    if overflow:
+        populations.append(statistics["AllSites"]["Overflow"])
+    if normal:
+        populations.append(statistics["AllSites"]["Normal"])
+    if foursites:
+        populations.append(statistics["FourSites"]["All"])
+        if overflow:
+            populations.append(statistics["FourSites"]["Overflow"])
+        if normal:
+            populations.append(statistics["FourSites"]["Normal"])
+    for population in populations:
+        AddGroupToJobStatistics(population, exitcode, efficient, efficiencybin, row)
+
+
+def GroupedReportStatistics(groups, probehassite):
+    '''
+    Fold the partial sums of FetchGroupedJobStatistics into the report
+    aggregates
+    '''
+    statistics = NewReportStatistics()
+    for hostdescription, exitcode, efficient, efficiencybin, num, wallduration, cpuduration in groups:
+        overflow, normal, foursites = ClassifyHostDescription(hostdescription)
+        AddGroupToReportStatistics(statistics, overflow, normal, foursites and probehassite,
+                                   exitcode, efficient, efficiencybin, (num, wallduration, cpuduration))
+    return statistics
+
+
+def QueryGratiaGrouped(cursor):
+    '''
+    Fetch partial sums grouped by HostDescription, and classify overflow
+    and 4-site jobs client-side
+    '''
+    groups = FetchGroupedJobStatistics(cursor, EarliestEndTime, LatestEndTime, GlideinProbeName)
+    probehassite = ProbeHasSite(cursor, GlideinProbeName)
+    return GroupedReportStatistics(groups, probehassite)
+
+
+def ExitCodeDistribution(groups, probehassite):
+    '''
+    Fold the partial sums of FetchGroupedJobStatistics into the number
+    and walltime of jobs per ExitCode
+    key        value
+    AllSites   {Overflow, Normal} -> {ExitCode: [jobs, walltime]}
+    FourSites  {Overflow, Normal} -> {ExitCode: [jobs, walltime]}
+    '''
+    distribution = {}
+    for sitegroup in ["AllSites", "FourSites"]:
+        distribution[sitegroup] = {"Overflow": {}, "Normal": {}}
+    for hostdescription, exitcode, efficient, efficiencybin, num, wallduration, cpuduration in groups:
+        overflow, normal, foursites = ClassifyHostDescription(hostdescription)
+        if overflow:
+            population = "Overflow"
+        elif normal:
+            population = "Normal"
+        else:
+            continue
+        sitegroups = ["AllSites"]
+        if foursites and probehassite:
+            sitegroups.append("FourSites")
+        for sitegroup in sitegroups:
+            codes = distribution[sitegroup][population]
+            if exitcode not in codes:
+                codes[exitcode] = [0, 0.0]
+            codes[exitcode][0] += int(num)
+            if wallduration is not None:
+                codes[exitcode][1] += float(wallduration)
+    return distribution
+
+
+def QueryExitCodeDistribution(cursor):
+    '''
+    Fetch the ExitCode distribution of the report window with one grouped
+    query, however many exit codes there are
+    '''
+    groups = FetchGroupedJobStatistics(cursor, EarliestEndTime, LatestEndTime, GlideinProbeName)
+    return ExitCodeDistribution(groups, ProbeHasSite(cursor, GlideinProbeName))
+
+
+def PrintExitCodeDistribution(distribution, top):
+    '''
+    Print the top most frequent exit codes of each population, with their
+    share of the jobs and of the walltime
+    '''
+    print "\nExit codes (top %d)" % top
+    for sitegroup, title in [("AllSites", "All sites"), ("FourSites", "Only %s" % FourSitesTitle)]:
+        print "\n%s\n" % title
+        for population in ["Overflow", "Normal"]:
+            codes = distribution[sitegroup][population]
+            num = sum([value[0] for value in codes.values()])
+            wallduration = sum([value[1] for value in codes.values()])
+            ranked = sorted(codes.items(), key=lambda item: (-item[1][0], item[0]))[:top]
+            shares = []
+            for exitcode, (codenum, codewallduration) in ranked:
+                if exitcode is None:
+                    name = "NULL"
+                elif float(exitcode) == int(float(exitcode)):
+                    name = "%d" % int(float(exitcode))
+                else:
+                    name = "%s" % exitcode
+                if wallduration > 0:
+                    wallshare = codewallduration * 100.0 / wallduration
+                else:
+                    wallshare = 0.0
+                shares.append("%s %.2f%s wall %.2f%s" % (name, codenum * 100.0 / num, "%", wallshare, "%"))
+            print "%s: %s" % (population, ", ".join(shares))
+
+
+def ReportProbes(cursor, probenames, efficiencythresholds, exitcodes):
+    '''
+    Print the report of each probe, all computed from one grouped scan,
+    with the efficiency thresholds and the top exitcodes exit codes when
+    asked for
+    '''
+    groupsbyprobe = FetchGroupedJobStatisticsByProbe(cursor, EarliestEndTime, LatestEndTime, probenames)
+    for probename in probenames:
+        groups = groupsbyprobe.get(probename, [])
+        probehassite = ProbeHasSite(cursor, probename)
+        statistics = GroupedReportStatistics(groups, probehassite)
+        print "\nReport of %s" % probename
+        PrintReport(statistics)
+        if efficiencythresholds:
+            PrintEfficiencyThresholds(statistics, efficiencythresholds)
+        if exitcodes > 0:
+            PrintExitCodeDistribution(ExitCodeDistribution(groups, probehassite), exitcodes)
+
+
+'''
+Time-sliced scans.  One grouped query over a week or a month runs for
+long enough to time out and hold back gratia's replication, so
+WindowScanner cuts the window into adjacent slices [start, end) and
+runs the grouped query of each slice on a connection of the pool, a few
+at a time.  The partial sums of all slices add up to those of the whole
+window.  Slices start at slicelength; after each one the length is
+adapted so that a slice takes about targetseconds at the observed rate
+(jobs per second of query time over jobs per second of EndTime), never
+more than doubling or halving at once.
+'''
+class WindowScanner(object):
+    '''
+    Scan a window in slices over the connections of a pool, see above
+    '''
+
+    def __init__(self, pool, maxworkers, slicelength=timedelta(0, 3600), targetseconds=10.0):
+        self.pool = pool
+        self.maxworkers = maxworkers
+        self.slicelength = slicelength
+        self.targetseconds = targetseconds
+        self.lock = threading.Lock()
+
+    def scan(self, earliest, latest, probename):
+        '''
+        Return the rows of FetchGroupedJobStatistics for [earliest, latest),
+        one list per slice in time order
+        '''
+        self.next = earliest
+        self.latest = latest
+        self.probename = probename
+        self.results = {}
+        self.errors = []
+        threads = []
+        for i in range(self.maxworkers):
+            thread = threading.Thread(target=self.work)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if self.errors:
+            errortype, errorvalue, errortraceback = self.errors[0]
+            raise errortype, errorvalue, errortraceback
+        return [self.results[start] for start in sorted(self.results)]
+
+    def take(self):
+        '''
+        Return the next slice, or None when the window is done
+        '''
+        self.lock.acquire()
+        try:
+            if self.errors or self.next >= self.latest:
+                return None
+            start = self.next
+            self.next = min(start + self.slicelength, self.latest)
+            return start, self.next
+        finally:
+            self.lock.release()
+
+    def adapt(self, start, end, groups, elapsed):
+        '''
+        Resize the next slices from the time a slice of jobs took
+        '''
+        jobs = sum([int(group[4]) for group in groups])
+        seconds = (end - start).days * 86400 + (end - start).seconds
+        if jobs == 0 or seconds == 0 or elapsed <= 0:
+            return
+        jobspersecond = jobs / elapsed
+        jobsperendtimesecond = float(jobs) / seconds
+        length = self.targetseconds * jobspersecond / jobsperendtimesecond
+        self.lock.acquire()
+        try:
+            current = self.slicelength.days * 86400 + self.slicelength.seconds
+            length = max(current / 2.0, min(current * 2.0, length))
+            self.slicelength = timedelta(0, max(60, int(length)))
+        finally:
+            self.lock.release()
+
+    def work(self):
+        try:
+            connection = self.pool.get()
+        except Exception:
+            # scan() raises it, and take() stops the other workers
+            self.errors.append(sys.exc_info())
+            return
+        try:
+            try:
+                cursor = connection.cursor()
+                try:
+                    while 1:
+                        window = self.take()
+                        if window is None:
+                            break
+                        start, end = window
+                        began = time.time()
+                        groups = FetchGroupedJobStatistics(cursor, start, end, self.probename)
+                        self.results[start] = groups
+                        self.adapt(start, end, groups, time.time() - began)
+                finally:
+                    cursor.close()
+            except Exception:
+                self.errors.append(sys.exc_info())
+        finally:
+            self.pool.put(connection)
+
+
+def SlicedReportStatistics(pool, maxworkers, earliest, latest, probename, slicelength=timedelta(0, 3600)):
+    '''
+    Compute the report aggregates of [earliest, latest) with a WindowScanner
+    '''
+    scanner = WindowScanner(pool, maxworkers, slicelength)
+    groups = []
+    for slicegroups in scanner.scan(earliest, latest, probename):
+        groups.extend(slicegroups)
+    connection = pool.get()
+    try:
+        cursor = connection.cursor()
+        probehassite = ProbeHasSite(cursor, probename)
+        cursor.close()
+    finally:
+        pool.put(connection)
+    return GroupedReportStatistics(groups, probehassite)
+
+
+def RangeReport(firstday, lastday, maxworkers, slicelength):
+    '''
+    Print one report for the window from the start of firstday's report
+    window to the end of lastday's, scanned in slices
+    '''
+    earliest = UCSDReportWindow(firstday)[0]
+    latest = UCSDReportWindow(lastday)[1]
+    pool = ConnectionPool(ConnectGratia, maxworkers)
+    try:
+        statistics = SlicedReportStatistics(pool, maxworkers, earliest, latest, GlideinProbeName, slicelength)
+    finally:
+        pool.close()
+    print "\nReport of %s--%s" % (earliest.strftime("%Y-%m-%d %H:%M:%S GMT"), latest.strftime("%Y-%m-%d %H:%M:%S GMT"))
+    PrintReport(statistics)
+
+
+'''
+Daily rollup.  The per-day aggregates are kept in a local SQLite file,
+one row per (day, probe, HostDescription, exit code, efficiency > 80%,
+efficiency bin) with the number of jobs and their wall and cpu sums,
+so that reports over any range of days are summed from the rollup
+instead of scanned from JobUsageRecord.  The HostDescription are only
+classified (overflow or not, 4-site group) when the rollup is read, so
+finalized days follow a change of --site-groups.  A day is the 24-hour
+window of UCSDReportWindow.  Gratia keeps receiving late records for a while, so a
+day is only marked finalized once its window ended RollupFinalizeAfter
+ago; days that are missing or not finalized are (re)computed from gratia
+with one grouped scan.  Jobs with a NULL HostDescription are in no
+population of the report, and are left out.
+main sets the file from the command line.
+'''
+RollupDatabase = None
+RollupFinalizeAfter = timedelta(2, 0)
+
+def OpenRollup(path):
+    '''
+    Open (and create if needed) the rollup file.  A rollup from before the
+    efficiency bins, or one keeping a site group instead of the
+    HostDescription, is dropped, and rebuilt as days are asked for.
+    '''
+    rollup = sqlite3.connect(path)
+    columns = [row[1] for row in rollup.execute("PRAGMA table_info(OverflowRollup)")]
+    if columns and ("EfficiencyBin" not in columns or "HostDescription" not in columns):
+        rollup.executescript("DROP TABLE OverflowRollup; DROP TABLE RollupDays;")
+    rollup.executescript("""
+    CREATE TABLE IF NOT EXISTS OverflowRollup (
+        Day TEXT, ProbeName TEXT, HostDescription TEXT,
+        ExitCode REAL, EfficiencyGT80percent INTEGER, EfficiencyBin INTEGER,
+        Jobs INTEGER, WallDuration REAL, UserAndSystemDuration REAL);
+    CREATE INDEX IF NOT EXISTS OverflowRollupDay ON OverflowRollup (ProbeName, Day);
+    CREATE TABLE IF NOT EXISTS RollupDays (
+        Day TEXT, ProbeName TEXT, Finalized INTEGER,
+        PRIMARY KEY (Day, ProbeName));
+    """)
+    return rollup
+
+
+def RollupDay(rollup, cursor, day, probename):
+    '''
+    Compute the rollup rows of one day from gratia, and replace that day
+    in the rollup
+    '''
+    earliest, latest = UCSDReportWindow(day)
+    groups = FetchGroupedJobStatistics(cursor, earliest, latest, probename)
+    cells = {}
+    for hostdescription, exitcode, efficient, efficiencybin, num, wallduration, cpuduration in groups:
+        if hostdescription is None:
+            continue
+        if efficiencybin is not None:
+            efficiencybin = int(efficiencybin)
+        key = (hostdescription, exitcode, int(bool(efficient)), efficiencybin)
+        cell = cells.setdefault(key, [0, 0.0, 0.0])
+        cell[0] += int(num)
+        cell[1] += float(wallduration or 0)
+        cell[2] += float(cpuduration or 0)
+    dayname = day.strftime("%Y-%m-%d")
+    finalized = latest + RollupFinalizeAfter <= datetime.utcnow()
+    rollup.execute("DELETE FROM OverflowRollup WHERE Day=? AND ProbeName=?", (dayname, probename))
+    rollup.executemany("INSERT INTO OverflowRollup VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                       [(dayname, probename) + key + tuple(cell) for key, cell in cells.iteritems()])
+    rollup.execute("INSERT OR REPLACE INTO RollupDays VALUES (?, ?, ?)", (dayname, probename, int(finalized)))
+    rollup.commit()
+
+
+def RollupReportStatistics(rollup, cursor, days, probename):
+    '''
+    Return the report aggregates of the jobs of all days together, after
+    rolling up from gratia the days that are not finalized yet.  The
+    24-hour windows overlap by an hour on the spring DST change, so a
+    range over it counts that hour twice, as the daily reports do.
+    '''
+    for day in days:
+        row = rollup.execute("SELECT Finalized FROM RollupDays WHERE Day=? AND ProbeName=?",
+                             (day.strftime("%Y-%m-%d"), probename)).fetchone()
+        if row is None or not row[0]:
+            RollupDay(rollup, cursor, day, probename)
+    groups = rollup.execute("""
+    SELECT HostDescription, ExitCode, EfficiencyGT80percent, EfficiencyBin,
+        SUM(Jobs), SUM(WallDuration), SUM(UserAndSystemDuration)
+    FROM OverflowRollup
+    WHERE ProbeName=? AND Day IN (%s)
+    GROUP BY HostDescription, ExitCode, EfficiencyGT80percent, EfficiencyBin
+    """ % ", ".join(["?"] * len(days)), [probename] + [day.strftime("%Y-%m-%d") for day in days])
+    return GroupedReportStatistics(groups, ProbeHasSite(cursor, probename))
+
+
+def QueryGratiaRollup(cursor):
+    '''
+    Compute today's report through the rollup (today is never finalized,
+    so this rolls it up from gratia and keeps the rollup current)
+    '''
+    if RollupDatabase is None:
+        raise ValueError("the rollup strategy needs a rollup file")
+    rollup = OpenRollup(RollupDatabase)
+    try:
+        return RollupReportStatistics(rollup, cursor, [today.date()], GlideinProbeName)
+    finally:
+        rollup.close()
+
+
+def RollupReport(cursor, firstday, lastday):
+    '''
+    Print one report for all the days from firstday to lastday (included),
+    e.g. a week or a month, from the rollup
+    '''
+    days = []
+    day = firstday
+    while day <= lastday:
+        days.append(day)
+        day += timedelta(1)
+    rollup = OpenRollup(RollupDatabase)
+    try:
+        statistics = RollupReportStatistics(rollup, cursor, days, GlideinProbeName)
+    finally:
+        rollup.close()
+    print "\nReport of %s--%s" % (firstday.strftime("%Y-%m-%d"), lastday.strftime("%Y-%m-%d"))
+    PrintReport(statistics)
+
+
+QueryGratiaStrategies = {
+    "perquery": QueryGratiaPerQuery,
+    "singlescan": QueryGratiaSingleScan,
+    "columnar": QueryGratiaColumnar,
+    "hashjoin": QueryGratiaHashJoin,
+    "paged": QueryGratiaPaged,
+    "grouped": QueryGratiaGrouped,
+    "incremental": QueryGratiaIncremental,
+    "rollup": QueryGratiaRollup,
+    }
+
+# Strategies whose queries split into independent parts for QueryExecutor;
+# the other strategies run as a single task
+QueryGratiaParallelTasks = {
+    "perquery": [QueryGratiaPerQueryAllSites, QueryGratiaPerQueryFourSites],
+    }
+
+
+def PrintReport(statistics):
+    '''
+    Compute the percentages and efficiencies of the report from the
+    aggregates, and print out the statistics
+    '''
+
+    # All sites
+    overflow = statistics["AllSites"]["Overflow"]
+    normal = statistics["AllSites"]["Normal"]
+    NumOverflowJobs = overflow["Num"]
+    WallDurationOverflowJobs = overflow["WallDuration"]
+    UserAndSystemDurationOverflowJobs = overflow["UserAndSystemDuration"]
+    NumNormalJobs = normal["Num"]
+    WallDurationNormalJobs = normal["WallDuration"]
+    UserAndSystemDurationNormalJobs = normal["UserAndSystemDuration"]
+    NumAllJobs = NumOverflowJobs + NumNormalJobs
+    WallDurationAllJobs = WallDurationOverflowJobs + WallDurationNormalJobs
+
+    # Compute efficiency of overflow jobs, which is equal to (CpuUserDuration+CpuSystemDuration)/WallDuration (in all sites)
+    if (WallDurationOverflowJobs==0):
+        EfficiencyOverflowJobs = 0
+    else:
+        EfficiencyOverflowJobs = float(100* UserAndSystemDurationOverflowJobs)/WallDurationOverflowJobs;
+
+    # Compute the efficiency of normal jobs (in all sites)
+    if (WallDurationNormalJobs == 0):
+        EfficiencyNormalJobs = 0
+    else:
+        EfficiencyNormalJobs = float(100*UserAndSystemDurationNormalJobs)/WallDurationNormalJobs
+
+    # Compute the percentage of number of overflow jobs OVER number of all jobs (in all sites)
+    if (NumAllJobs==0):
+        PercentageOverflowJobs = 0
+    else:
+        PercentageOverflowJobs = float(NumOverflowJobs*100)/NumAllJobs;
+ 
+    # Compute the percentage of walltime of overflow jobs OVER walltime of all jobs (in all sites)
+    if (WallDurationAllJobs==0):
+        PercentageWallDurationOverflowJobs = 0
+    else:
+        PercentageWallDurationOverflowJobs = float(WallDurationOverflowJobs*100)/WallDurationAllJobs;
+
+    # Compute the percentage of number of overflow jobs with exit code 0 OVER number of overflow jobs (in all sites)
+    if (NumOverflowJobs==0):
+        PercentageExitCode0Overflow = 0
+    else:
+        PercentageExitCode0Overflow =float(100*overflow["NumExitCode0"])/ NumOverflowJobs
+
+    # Compute the walltime percentage of walltime of overflow jobs with exit code 0 OVER walltime of overflow jobs (in all sites)
+    if (WallDurationOverflowJobs==0):
+        PercentageWallDurationOverflowJobsExitCode0 = 0
+    else:
+        PercentageWallDurationOverflowJobsExitCode0 = float(100*overflow["WallDurationExitCode0"])/WallDurationOverflowJobs;
+  
+    # Compute the percentage of number normal jobs with exit code 0 OVER number of normal jobs (in all sites)
+    if (NumNormalJobs==0):
+        PercentageExitCode0Normal = 0
+    else:
+        PercentageExitCode0Normal = float(100*normal["NumExitCode0"])/NumNormalJobs
+
+    # Compute the percentage of number of overflow jobs with exit code 84 OVER number of overflow jobs (in all sites)
+    if (NumOverflowJobs==0):
+        PercentageNumOverflowJobsExitCode84 = 0
+    else:
+        PercentageNumOverflowJobsExitCode84 = float(100*overflow["NumExitCode84"])/NumOverflowJobs;
+
+    # Compute the percentage of walltime of overflow jobs with exit code 84 OVER walltime of overflow jobs (in all sites) 
+    if (WallDurationOverflowJobs==0):
+        PercentageWallDurationOverflowJobsExitCode84 = 0
+    else:
+        PercentageWallDurationOverflowJobsExitCode84 = float(100*overflow["WallDurationExitCode84"])/WallDurationOverflowJobs;     
+
+    # Compute the percentage of number of normal jobs with exit code 84 OVER number of normal jobs (in all sites) 
+    if (NumNormalJobs==0):
+        PercentageNumNormalJobsExitCode84 = 0
+    else:
+        PercentageNumNormalJobsExitCode84 = float(100*normal["NumExitCode84"])/NumNormalJobs
+
+    # Compute the percentage of number of overflow jobs whose efficiency greater than 80% (in all sites)
+    if (NumOverflowJobs == 0):
+        PercentageEfficiencyGT80percentOverflowJobs = 0
+    else:
+        PercentageEfficiencyGT80percentOverflowJobs = float(100*overflow["NumEfficiencyGT80percent"])/NumOverflowJobs
+
+    # Compute the percentage of number of normal jobs whose efficiency greater than 80% (in all sites)
+    if (NumNormalJobs == 0):
+        PercentageEfficiencyGT80percentNormalJobs = 0
     else:
-        PercentageWallDurationOverflowJobsExitCode84foursites = float(100*WallDurationOverflowJobsExitCode84foursites)/WallDurationOverflowJobs4sites
-    #print str(PercentageWallDurationOverflowJobsExitCode84foursites)+"%"
+        PercentageEfficiencyGT80percentNormalJobs = float(100*normal["NumEfficiencyGT80percent"])/NumNormalJobs
+
+    # 4 sites
+    overflow = statistics["FourSites"]["Overflow"]
+    normal = statistics["FourSites"]["Normal"]
+    NumAllJobs4sites = statistics["FourSites"]["All"]["Num"]
+    WallDurationAllJobs4sites = statistics["FourSites"]["All"]["WallDuration"]
+    NumOverflowJobs4sites = overflow["Num"]
+    WallDurationOverflowJobs4sites = overflow["WallDuration"]
+    UserAndSystemDurationOverflowJobs4sites = overflow["UserAndSystemDuration"]
+    NumNormalJobs4sites = normal["Num"]
+    WallDurationNormalJobs4sites = normal["WallDuration"]
+    UserAndSystemDurationNormalJobs4sites = normal["UserAndSystemDuration"]
 
-    # Compute number of normal jobs with exit code 84 (in 4 sites)
-    querystring = """
-    SELECT
-        COUNT(*)
-    from JobUsageRecord JUR 
-    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
-    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
-    where
-      EndTime>=%s and EndTime<%s
-      AND RESC.value = 84
-      AND HostDescription NOT like '%%-overflow'
-      AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
-      AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
-     """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
-    row = cursor.fetchone()
-    NumNormalJobsExitCode84foursites = int(row[0])
+    # Compute the percentage of walltime of overflow jobs OVER walltime of all jobs (in 4 sites)
+    if (WallDurationAllJobs4sites == 0):
+        PercentageWallDurationOverflowJobs4sites = 0
+    else:
+        PercentageWallDurationOverflowJobs4sites = float(100*WallDurationOverflowJobs4sites)/WallDurationAllJobs4sites
+
+    # Compute the efficiency of overflow jobs (in 4 sites)
+    if (WallDurationOverflowJobs4sites == 0):
+        EfficiencyOverflowJobs4sites = 0
+    else:
+        EfficiencyOverflowJobs4sites = float(100* UserAndSystemDurationOverflowJobs4sites)/WallDurationOverflowJobs4sites
+
+    # Compute the efficiency of normal jobs (in 4 sites)
+    if (WallDurationNormalJobs4sites == 0):
+        EfficiencyNormalJobs4sites = 0
+    else:
+        EfficiencyNormalJobs4sites = float(100*UserAndSystemDurationNormalJobs4sites)/WallDurationNormalJobs4sites
+  
+    # Compute the percentage of number of overflow jobs OVER number of all jobs (in 4 sites)
+    if (NumAllJobs4sites == 0):
+        PercentageOverflowJobs4sites = 0
+    else:
+        PercentageOverflowJobs4sites = float(100*NumOverflowJobs4sites)/NumAllJobs4sites;
+
+    # Compute the percentage of number of overflow jobs with exit code 0 OVER number of overflow jobs (in 4 sites)
+    if (NumOverflowJobs4sites == 0):
+        PercentageOverflowJobsExitCode0foursites = 0
+    else:
+        PercentageOverflowJobsExitCode0foursites = float(100*overflow["NumExitCode0"])/NumOverflowJobs4sites
+
+    # Compute the percentage of walltime of overflow jobs with exit code 0 OVERFLOW the walltime of all overflow jobs (in 4 sites)
+    if (WallDurationOverflowJobs4sites == 0):
+        PercentageWallDurationOverflowJobsExitCode0foursites = 0
+    else:
+        PercentageWallDurationOverflowJobsExitCode0foursites = float(100*overflow["WallDurationExitCode0"])/WallDurationOverflowJobs4sites
+
+    # Compute the percentage of number of normal jobs with exit code 0 OVER number of normal jobs (in 4 sites)
+    if (NumNormalJobs4sites == 0):
+        PercentageNormalJobsExitCode0foursites = 0
+    else:
+        PercentageNormalJobsExitCode0foursites = float(100*normal["NumExitCode0"])/NumNormalJobs4sites
+
+    # Compute percentage of number of overflow jobs with exit code 84 OVER number of overflow jobs (in 4 sites)
+    if (NumOverflowJobs4sites == 0):
+        PercentageOverflowJobsExitCode84foursites = 0
+    else:
+        PercentageOverflowJobsExitCode84foursites = float(100*overflow["NumExitCode84"])/NumOverflowJobs4sites
+
+    # Compute the percentage of walltime of overflow jobs with exit code 84 OVER walltime of overflow jobs (in 4 sites) 
+    if (WallDurationOverflowJobs4sites == 0):
+        PercentageWallDurationOverflowJobsExitCode84foursites  = 0
+    else:
+        PercentageWallDurationOverflowJobsExitCode84foursites = float(100*overflow["WallDurationExitCode84"])/WallDurationOverflowJobs4sites
 
     # Compute percentage of number of normal jobs with exit code 84 OVER number of normal jobs (in 4 sites)
     if (NumNormalJobs4sites == 0):
         PercentageNormalJobsExitCode84foursites = 0
     else:
-        PercentageNormalJobsExitCode84foursites = float(100*NumNormalJobsExitCode84foursites)/NumNormalJobs4sites
-    #print str(PercentageNormalJobsExitCode84foursites)+"%"
+        PercentageNormalJobsExitCode84foursites = float(100*normal["NumExitCode84"])/NumNormalJobs4sites
 
     # Compute the percentage of number of overflow jobs whose efficiency greater than 80% (in 4 sites)
-    querystring = """
-    SELECT
-        COUNT(*)
-    from JobUsageRecord JUR 
-    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
-    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
-    where
-      EndTime>=%s and EndTime<%s
-      AND HostDescription like '%%-overflow'
-      AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
-      AND (CpuUserDuration+CpuSystemDuration)/WallDuration>0.8
-      AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
-     """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
-    row = cursor.fetchone()
-    NumEfficiencyGT80percentOverflowJobs4sites = int(row[0])
     if (NumOverflowJobs4sites == 0):
         PercentageEfficiencyGT80percentOverflowJobs4sites = 0
     else:
-        PercentageEfficiencyGT80percentOverflowJobs4sites = float(100*NumEfficiencyGT80percentOverflowJobs4sites)/NumOverflowJobs4sites
-    #print str(PercentageEfficiencyGT80percentOverflowJobs4sites) + "%"
+        PercentageEfficiencyGT80percentOverflowJobs4sites = float(100*overflow["NumEfficiencyGT80percent"])/NumOverflowJobs4sites
 
     # Compute the percentage of normal jobs whose efficiency greater than 80% (in 4 sites)
-    querystring = """
-    SELECT
-        COUNT(*)
-    from JobUsageRecord JUR 
-    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
-    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
-    JOIN Probe P on (JURM.ProbeName = P.probename)
-    JOIN Site S on (P.siteid = S.siteid)
-    where
-      EndTime>=%s and EndTime<%s
-      AND HostDescription NOT like '%%-overflow'
-      AND ResourceType="BatchPilot"
-      AND (HostDescription like '%%Nebraska%%' or HostDescription like '%%UCSD%%' or HostDescription like '%%Purdue%%' or HostDescription like '%%GLOW%%')
-      AND (CpuUserDuration+CpuSystemDuration)/WallDuration>0.8
-      AND JURM.ProbeName="condor:glidein-2.t2.ucsd.edu"
-     """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
-    row = cursor.fetchone()
-    NumEfficiencyGT80percentNormalJobs4sites = int(row[0])
     if (NumNormalJobs4sites == 0):
         PercentageEfficiencyGT80percentNormalJobs4sites = 0
     else:
-        PercentageEfficiencyGT80percentNormalJobs4sites = float(100*NumEfficiencyGT80percentNormalJobs4sites)/NumNormalJobs4sites
-    #print str(PercentageEfficiencyGT80percentNormalJobs4sites) + "%"
+        PercentageEfficiencyGT80percentNormalJobs4sites = float(100*normal["NumEfficiencyGT80percent"])/NumNormalJobs4sites
     
     # Print out the statistics 
     print "\nAll sites\n"
@@ -651,7 +2577,7 @@ def QueryGratia(cursor):
 
     print "Eff  >80%s: %.2f%s (vs %.2f%s)" % ("%", PercentageEfficiencyGT80percentOverflowJobs, "%", PercentageEfficiencyGT80percentNormalJobs, "%")
 
-    print "\nOnly UCSD+Nebraska+Wisconsin+Purdue\n"
+    print "\nOnly %s\n" % FourSitesTitle
 
     print "Overflow: %d: (%.2f%s wall %.2f%s) Normal:%d" % (NumOverflowJobs4sites, PercentageOverflowJobs4sites, "%", PercentageWallDurationOverflowJobs4sites, "%", NumNormalJobs4sites)
 
@@ -664,6 +2590,160 @@ def QueryGratia(cursor):
     print "Eff  >80%s: %.2f%s (vs %.2f%s)" % ("%", PercentageEfficiencyGT80percentOverflowJobs4sites, "%", PercentageEfficiencyGT80percentNormalJobs4sites, "%")
 
 
+'''
+Efficiency thresholds and percentiles, answered from the efficiency
+histogram of the report aggregates (see EfficiencyBinEdges) without
+going back to gratia.  Thresholds must be bin edges.
+'''
+def EfficiencyThresholdBin(threshold):
+    '''
+    Return the first bin above the bin edge threshold, or None if
+    threshold is not an edge
+    '''
+    for index, edge in enumerate(EfficiencyBinEdges):
+        if abs(edge - threshold) < 1e-9:
+            return index + 1
+    return None
+
+
+def EfficiencyAbove(statistics, threshold, weight="Num"):
+    '''
+    Return the percentage of the jobs (weight "Num") or of their walltime
+    (weight "WallDuration") with an efficiency greater than threshold
+    '''
+    total = statistics[weight]
+    if total == 0:
+        return 0
+    above = 0
+    for efficiencybin in range(EfficiencyThresholdBin(threshold), EfficiencyBins):
+        numkey, walldurationkey = EfficiencyBinKeys(efficiencybin)
+        above += statistics[{"Num": numkey, "WallDuration": walldurationkey}[weight]]
+    return float(100 * above) / total
+
+
+def EfficiencyPercentile(statistics, fraction, weight="Num"):
+    '''
+    Return the efficiency below which fraction of the jobs (or of their
+    walltime) are, interpolating linearly within a bin; the last bin is
+    open, so it answers with its lower edge
+    '''
+    counts = []
+    for efficiencybin in range(EfficiencyBins):
+        numkey, walldurationkey = EfficiencyBinKeys(efficiencybin)
+        counts.append(statistics[{"Num": numkey, "WallDuration": walldurationkey}[weight]])
+    total = sum(counts)
+    if total == 0:
+        return 0
+    lower = 0.0
+    cumulative = 0
+    for efficiencybin, count in enumerate(counts):
+        if efficiencybin == EfficiencyBins - 1:
+            return lower
+        upper = EfficiencyBinEdges[efficiencybin]
+        if count > 0 and cumulative + count >= fraction * total:
+            return lower + (upper - lower) * (fraction * total - cumulative) / count
+        cumulative += count
+        lower = upper
+    return lower
+
+
+def PrintEfficiencyThresholds(statistics, thresholds):
+    '''
+    Print, for overflow (vs normal) jobs, the share of jobs and walltime
+    above each threshold and the median efficiencies
+    '''
+    for sitegroup, title in [("AllSites", "All sites"), ("FourSites", "Only %s" % FourSitesTitle)]:
+        overflow = statistics[sitegroup]["Overflow"]
+        normal = statistics[sitegroup]["Normal"]
+        print "\nEfficiency, %s\n" % title
+        for threshold in thresholds:
+            print "Eff %3s%s: %.2f%s (vs %.2f%s) wall %.2f%s (vs %.2f%s)" % (
+                ">%d" % int(round(threshold * 100)), "%",
+                EfficiencyAbove(overflow, threshold), "%", EfficiencyAbove(normal, threshold), "%",
+                EfficiencyAbove(overflow, threshold, "WallDuration"), "%",
+                EfficiencyAbove(normal, threshold, "WallDuration"), "%")
+        print "Eff median: %.2f (vs %.2f) wall %.2f (vs %.2f)" % (
+            EfficiencyPercentile(overflow, 0.5), EfficiencyPercentile(normal, 0.5),
+            EfficiencyPercentile(overflow, 0.5, "WallDuration"), EfficiencyPercentile(normal, 0.5, "WallDuration"))
+
+
+def UCSDReportWindow(day):
+    '''
+    Return (EarliestEndTime, LatestEndTime) of the report UCSD sends on
+    day: the 24 hours ending at 6am Pacific that day, as UTC datetimes
+    (the same window as computed above for today)
+    '''
+    UCSD_start = timezone("US/Pacific").localize(datetime(day.year, day.month, day.day, 6, 0, 0))
+    latest = UCSD_start.astimezone(utc).replace(tzinfo=None)
+    return latest - timedelta(1, 0), latest
+
+
+def FetchJobColumnsInBatches(cursor, earliest, latest, probename, batchsize=100000):
+    '''
+    Run one query for the columns (with EndTime) of every job in
+    [earliest, latest), and yield them batchsize rows at a time.  Give it
+    a server-side cursor so the rows stream instead of being buffered.
+    '''
+    querystring = """
+    SELECT
+        JUR.dbid, HostDescription, RESC.value+0, WallDuration, CpuUserDuration+CpuSystemDuration, EndTime
+    from JobUsageRecord JUR
+    JOIN JobUsageRecord_Meta JURM on (JUR.dbid = JURM.dbid)
+    JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
+    where
+      EndTime>=%s and EndTime<%s
+      AND ResourceType="BatchPilot"
+      AND JURM.ProbeName=%s
+     """
+    cursor.execute(querystring, (earliest, latest, probename))
+    while 1:
+        rows = cursor.fetchmany(batchsize)
+        if not rows:
+            break
+        yield BuildJobColumns(rows, True)
+
+
+def BackfillReportStatistics(cursor, streamcursor, days, probename):
+    '''
+    Compute the report aggregates of every day in days with a single
+    query over the whole span: the rows are bucketed into each day's
+    report window client-side.  Windows are 24 hours long, so around DST
+    changes they overlap or leave a gap, exactly as the daily reports do.
+    Return one set of aggregates per day.
+    '''
+    windows = [UCSDReportWindow(day) for day in days]
+    epochwindows = [(calendar.timegm(earliest.timetuple()), calendar.timegm(latest.timetuple())) for earliest, latest in windows]
+    probehassite = ProbeHasSite(cursor, probename)
+    statistics = [NewReportStatistics() for day in days]
+    earliest = min([window[0] for window in windows])
+    latest = max([window[1] for window in windows])
+    for columns in FetchJobColumnsInBatches(streamcursor, earliest, latest, probename):
+        endtime = columns["EndTime"]
+        for index, (earliestepoch, latestepoch) in enumerate(epochwindows):
+            mask = (endtime >= earliestepoch) & (endtime < latestepoch)
+            if mask.any():
+                MergeReportStatistics(statistics[index], ColumnarReportStatistics(SelectJobColumns(columns, mask), probehassite))
+    return statistics
+
+
+def Backfill(db, firstday, lastday):
+    '''
+    Print the report of every day from firstday to lastday (included)
+    '''
+    if numpy is None:
+        raise ImportError("backfill needs numpy")
+    days = []
+    day = firstday
+    while day <= lastday:
+        days.append(day)
+        day += timedelta(1)
+    statistics = BackfillReportStatistics(db.cursor(), db.cursor(MySQLdb.cursors.SSCursor), days, GlideinProbeName)
+    for day, daystatistics in zip(days, statistics):
+        earliest, latest = UCSDReportWindow(day)
+        print "\nReport of %s: %s--%s" % (day.strftime("%Y-%m-%d"), earliest.strftime("%Y-%m-%d %H:%M:%S GMT"), latest.strftime("%Y-%m-%d %H:%M:%S GMT"))
+        PrintReport(daystatistics)
+
+
 def FilterCondorJobs(cursor):
 
     '''
@@ -675,8 +2755,57 @@ def FilterCondorJobs(cursor):
            /store/mc/Fall11/WJetsToLNu_TuneZ2_7TeV-madgraph-tauola/AODSIM/PU_S6_START42_V14B-v1/0000/1EEE763D-1AF2-E011-8355-00304867D446.root
     '''
 
-    # Find those overflow jobs whose exit code is 84 and resource type is BatchPilot 
-    querystring = """
+    MatchOverflowJobsExitCode84(FetchOverflowJobsExitCode84(cursor))
+
+
+def FetchOverflowJobsExitCode84(cursor):
+    '''
+    Return (dbid, LocalJobId, CommonName, Host, StartTime, EndTime) of the
+    overflow jobs with exit code 84
+    '''
+    ExecuteOverflowJobsExitCode84(cursor)
+    return cursor.fetchall()
+
+
+def StreamOverflowJobsExitCode84(streamcursor, batchsize=1000):
+    '''
+    Yield the rows of FetchOverflowJobsExitCode84 as they arrive.  Give it
+    a server-side cursor (MySQLdb.cursors.SSCursor): a thread reads the
+    result with fetchmany into a queue of a few batches, so memory stays
+    bounded and the caller matches one batch while the next is on the
+    wire.  The caller must read every row.
+    '''
+    batches = Queue.Queue(4)
+    errors = []
+    def fetch():
+        try:
+            ExecuteOverflowJobsExitCode84(streamcursor)
+            while 1:
+                rows = streamcursor.fetchmany(batchsize)
+                if not rows:
+                    break
+                batches.put(rows)
+        except Exception:
+            errors.append(sys.exc_info())
+        batches.put(None)
+    fetcher = threading.Thread(target=fetch)
+    fetcher.setDaemon(True)
+    fetcher.start()
+    while 1:
+        rows = batches.get()
+        if rows is None:
+            break
+        for row in rows:
+            yield row
+    fetcher.join()
+    if errors:
+        errortype, errorvalue, errortraceback = errors[0]
+        raise errortype, errorvalue, errortraceback
+
+
+# Find those overflow jobs whose exit code is 84 and resource type is BatchPilot
+# (ends with its where clause, for KeysetPages)
+OverflowJobsExitCode84Query = """
     SELECT JUR.dbid, LocalJobId, CommonName, Host, StartTime, EndTime
     from JobUsageRecord JUR
     JOIN Resource RESC on ((JUR.dbid = RESC.dbid) and (RESC.description="ExitCode"))
@@ -685,24 +2814,44 @@ def FilterCondorJobs(cursor):
       EndTime >= %s AND EndTime < %s
       AND ResourceType = "BatchPilot"
       AND RESC.value = 84
-      AND HostDescription like '%%-overflow';
-    """
-    cursor.execute(querystring, (EarliestEndTime, LatestEndTime));
+      AND HostDescription like '%%-overflow'"""
+
+def ExecuteOverflowJobsExitCode84(cursor):
+    '''
+    Execute the query of the overflow jobs with exit code 84, leaving the
+    rows to be fetched from cursor
+    '''
+    cursor.execute(OverflowJobsExitCode84Query, (EarliestEndTime, LatestEndTime));
+
+
+def PageOverflowJobsExitCode84(cursor, pagesize):
+    '''
+    Yield the rows of FetchOverflowJobsExitCode84, fetched in keyset pages
+    of pagesize rows
+    '''
+    for rows in KeysetPages(cursor, OverflowJobsExitCode84Query, (EarliestEndTime, LatestEndTime),
+                            EarliestEndTime, LatestEndTime, pagesize):
+        for row in rows:
+            yield row
+
+
+def MatchOverflowJobsExitCode84(rows):
+    '''
+    Check each overflow job with exit code 84 in the xrootd log, see FilterCondorJobs
+    '''
     # Handle each record
-    numrows = int(cursor.rowcount)
     print "\nPossible Overflow Jobs with Exit Code 84 based on xrootd log\n"
-    for i in range(numrows):
-        row = cursor.fetchone()
+    for row in rows:
         #print row[0], row[1], row[2], row[3], row[4], row[5]
         localjobid = row[1]
         commonname = row[2]
         host = row[3]
         starttime = row[4]
         endtime = row[5]
-	gmstarttime = starttime
-	gmendtime = endtime
-	#print host
-	if (host!="NULL"):
+        gmstarttime = starttime
+        gmendtime = endtime
+        #print host
+        if (host!="NULL"):
             # Check each job in xrootd log
             matchedflag = CheckJobMatchInXrootdLog(localjobid, commonname, host, starttime, endtime, gmstarttime, gmendtime)
 
@@ -810,64 +2959,7 @@ def buildJobLoginDisconnectionAndSoOnDictionary(filename):
     key     value
     jobid   [login time, disconnection time, filename, redirection site]
     '''
-    infile = open(filename)
-    # we scan this line
-    while 1:
-        line = infile.readline()
-        if not line:
-            break
-        # judge whether it is a login record 
-        matchflagLogin = re.match("(\d{2})(\d{2})(\d{2}) (\d{2}:\d{2}:\d{2}) \d+ XrootdXeq: (\S+) login\s*", line, 0)
-        if matchflagLogin:
-            # we try to build a dictionary
-            TheLoginDatetime = "20"+matchflagLogin.group(1)+"-"+matchflagLogin.group(2)+"-"+matchflagLogin.group(3)+" "+matchflagLogin.group(4); 
-            logintimestamp =  int(time.mktime(time.strptime(TheLoginDatetime, '%Y-%m-%d %H:%M:%S')))
-            jobid = matchflagLogin.group(5)
-            curjobLoginDisconnectionAndSoOn = jobLoginDisconnectionAndSoOnDictionary.get(jobid, None)
-            if (not curjobLoginDisconnectionAndSoOn):
-                curjobLoginDisconnectionAndSoOn = [None, None, None, None]
-                # includes login time, disconnection time, filename, and redirection site
-            curjobLoginDisconnectionAndSoOn[0] = logintimestamp
-            jobLoginDisconnectionAndSoOnDictionary[jobid] = curjobLoginDisconnectionAndSoOn
-            jobiditems = jobid.split("@")
-            currenthostname = jobiditems[1]
-            # this is a full host name
-            # currentjobs = hostnamejobsDictionary[currenthostname]
-            currentjobs = hostnameJobsDictionary.get(currenthostname, None)
-            if (not currentjobs):
-                currentjobs=[]
-            #print jobid
-            currentjobs.append(jobid)
-            hostnameJobsDictionary[currenthostname] = currentjobs
-            #print currenthostname
-            #print hostnameJobsDictionary[currenthostname]
-        else: # else we judge whether it is a disconnection record
-            matchflagDisconnection = re.match("(\d{2})(\d{2})(\d{2}) (\d{1,2}:\d{2}:\d{2}) \d+ XrootdXeq: (\S+) disc \d{1,2}:\d{2}:\d{2}\n", line)
-            if matchflagDisconnection:
-                # we try to 
-                TheDisconnectionDatetime = "20"+matchflagDisconnection.group(1)+"-"+matchflagDisconnection.group(2)+"-"+matchflagDisconnection.group(3)+" "+matchflagDisconnection.group(4); 
-                disconnectiontimestamp =  int(time.mktime(time.strptime(TheDisconnectionDatetime, '%Y-%m-%d %H:%M:%S')))
-                jobid = matchflagDisconnection.group(5)
-                curjobLoginDisconnectionAndSoOn = jobLoginDisconnectionAndSoOnDictionary.get(jobid, None)
-                if (not curjobLoginDisconnectionAndSoOn):
-                    curjobLoginDisconnectionAndSoOn = [None, None, None, None]
-                curjobLoginDisconnectionAndSoOn[1] = disconnectiontimestamp
-                jobLoginDisconnectionAndSoOnDictionary[jobid] = curjobLoginDisconnectionAndSoOn
-            else:
-                matchflagFilenameRedirectionsite = re.match("\d{6} \d{1,2}:\d{2}:\d{2} \d+ Decode xrootd redirects (\S+) to (\S+) (\S+)\n", line)
-                if matchflagFilenameRedirectionsite:
-                    # we try to
-                    jobid = matchflagFilenameRedirectionsite.group(1)
-                    redirectionsite = matchflagFilenameRedirectionsite.group(2)
-                    thisjobfilename = matchflagFilenameRedirectionsite.group(3)
-                    curjobLoginDisconnectionAndSoOn = jobLoginDisconnectionAndSoOnDictionary.get(jobid, None)
-                    if (not curjobLoginDisconnectionAndSoOn):
-                        curjobLoginDisconnectionAndSoOn = [None, None, None, None]
-                    curjobLoginDisconnectionAndSoOn[2] = thisjobfilename
-                    curjobLoginDisconnectionAndSoOn[3] = redirectionsite
-                    jobLoginDisconnectionAndSoOnDictionary[jobid] = curjobLoginDisconnectionAndSoOn
-                
-    infile.close()
+    ParseXrootdLogFile(filename, jobLoginDisconnectionAndSoOnDictionary, hostnameJobsDictionary)
     # now, we show the dictonary
     #for key,value in jobLoginDisconnectionAndSoOnDictionary.iteritems():
      #  print key
@@ -876,21 +2968,591 @@ def buildJobLoginDisconnectionAndSoOnDictionary(filename):
     # print key
     # print value
 
+
+'''
+xrootd log records.  Login and disconnection records are "XrootdXeq:"
+lines, redirections are "Decode xrootd redirects" lines; all the others
+(most of the log) are skipped after a substring test, and each record
+line is matched by one precompiled expression.  The expressions match
+the lines the parser always matched, tried in the same order, so the
+dictionaries come out the same.
+'''
+XrootdLoginRecord = re.compile("(\d{6}) (\d{2}):(\d{2}):(\d{2}) \d+ XrootdXeq: (\S+) login\s*")
+XrootdDisconnectionRecord = re.compile("(\d{6}) (\d{1,2}):(\d{2}):(\d{2}) \d+ XrootdXeq: (\S+) disc \d{1,2}:\d{2}:\d{2}\n")
+XrootdRedirectionRecord = re.compile("\d{6} \d{1,2}:\d{2}:\d{2} \d+ Decode xrootd redirects (\S+) to (\S+) (\S+)\n")
+
+'''
+The log time stamps are local (US/Central, set above) "yymmdd H:MM:SS".
+Rather than strptime and mktime on every record, the epoch of each
+day's midnight is worked out once and the time of day is added to it.
+That only holds on days that are 24 hours long; on the two DST
+transition days of a year (and for anything strptime would not take)
+XrootdEpoch goes through strptime and mktime as before, so the time
+stamps are exactly the ones mktime gives.
+'''
+XrootdMidnights = {}
+
+def XrootdMidnight(day):
+    '''
+    Epoch of the local midnight starting day ("yymmdd"), or None when
+    the day is not 24 hours long
+    '''
+    midnight = int(time.mktime(time.strptime("20" + day, '%Y%m%d')))
+    nextday = time.localtime(midnight + 86400 + 7200)
+    nextmidnight = int(time.mktime((nextday.tm_year, nextday.tm_mon, nextday.tm_mday, 0, 0, 0, 0, 0, -1)))
+    if nextmidnight - midnight != 86400:
+        return None
+    return midnight
+
+def XrootdEpoch(day, hours, minutes, seconds):
+    '''
+    Epoch of the local time stamp day ("yymmdd") hours:minutes:seconds,
+    the same as mktime(strptime()) of it
+    '''
+    try:
+        midnight = XrootdMidnights[day]
+    except KeyError:
+        midnight = XrootdMidnight(day)
+        XrootdMidnights[day] = midnight
+    hours = int(hours)
+    minutes = int(minutes)
+    seconds = int(seconds)
+    if midnight is None or hours > 23 or minutes > 59 or seconds > 61:
+        return int(time.mktime(time.strptime("20%s %d:%d:%d" % (day, hours, minutes, seconds), '%Y%m%d %H:%M:%S')))
+    return midnight + 3600 * hours + 60 * minutes + seconds
+
+def ParseXrootdLog(lines, jobs, hostnames):
+    '''
+    Add the records of the xrootd log lines to the dictionaries
+    key       value
+    jobs      jobid -> [login time, disconnection time, filename, redirection site]
+    hostnames hostname -> [jobid of every login from it]
+    '''
+    matchLogin = XrootdLoginRecord.match
+    matchDisconnection = XrootdDisconnectionRecord.match
+    matchRedirection = XrootdRedirectionRecord.match
+    for line in lines:
+        if "XrootdXeq:" in line:
+            matchflagLogin = matchLogin(line)
+            if matchflagLogin:
+                logintimestamp = XrootdEpoch(*matchflagLogin.group(1, 2, 3, 4))
+                jobid = matchflagLogin.group(5)
+                curjobLoginDisconnectionAndSoOn = jobs.get(jobid, None)
+                if (not curjobLoginDisconnectionAndSoOn):
+                    # includes login time, disconnection time, filename, and redirection site
+                    curjobLoginDisconnectionAndSoOn = [None, None, None, None]
+                    jobs[jobid] = curjobLoginDisconnectionAndSoOn
+                curjobLoginDisconnectionAndSoOn[0] = logintimestamp
+                # this is a full host name
+                currenthostname = jobid.split("@")[1]
+                currentjobs = hostnames.get(currenthostname, None)
+                if (not currentjobs):
+                    currentjobs = []
+                    hostnames[currenthostname] = currentjobs
+                currentjobs.append(jobid)
+                continue
+            matchflagDisconnection = matchDisconnection(line)
+            if matchflagDisconnection:
+                disconnectiontimestamp = XrootdEpoch(*matchflagDisconnection.group(1, 2, 3, 4))
+                jobid = matchflagDisconnection.group(5)
+                curjobLoginDisconnectionAndSoOn = jobs.get(jobid, None)
+                if (not curjobLoginDisconnectionAndSoOn):
+                    curjobLoginDisconnectionAndSoOn = [None, None, None, None]
+                    jobs[jobid] = curjobLoginDisconnectionAndSoOn
+                curjobLoginDisconnectionAndSoOn[1] = disconnectiontimestamp
+                continue
+            # neither, so it may still be a redirection below
+        if "Decode xrootd redirects" in line:
+            matchflagFilenameRedirectionsite = matchRedirection(line)
+            if matchflagFilenameRedirectionsite:
+                jobid = matchflagFilenameRedirectionsite.group(1)
+                curjobLoginDisconnectionAndSoOn = jobs.get(jobid, None)
+                if (not curjobLoginDisconnectionAndSoOn):
+                    curjobLoginDisconnectionAndSoOn = [None, None, None, None]
+                    jobs[jobid] = curjobLoginDisconnectionAndSoOn
+                curjobLoginDisconnectionAndSoOn[2] = matchflagFilenameRedirectionsite.group(3)
+                curjobLoginDisconnectionAndSoOn[3] = matchflagFilenameRedirectionsite.group(2)
+
+
+'''
+Scanning mapped xrootd logs.  Nearly all of a log is lines that are
+neither records ParseXrootdLog wants, so rather than reading it a line
+at a time, the file is mapped and searched for the two record markers;
+only the lines holding one are cut out and handed to ParseXrootdLog,
+in the order they are in the file.  The map is searched a window of
+XrootdScanWindowBytes at a time, copied out as a string: mmap.find
+compares byte by byte, string find is several times faster.
+
+With XrootdLogReader "blocks" the file is read rather than mapped, a
+block of XrootdScanWindowBytes at a time, carrying the partial line at
+the end of a block over to the next, which also works for a pipe.  (A
+regular expression finding the records in a whole block, with finditer,
+was tried: the sre engine tries it at every newline, and even on just
+the record lines it is no faster than matching them one at a time.)
+'''
+XrootdScanWindowBytes = 8 * 1024 * 1024
+XrootdLogReader = "mapped"
+
+def XrootdWindowRecordLines(window, end):
+    '''
+    The lines of window[:end] (which ends a line) holding an xrootd
+    record marker, with their newline
+    '''
+    find = window.find
+    rfind = window.rfind
+    login = find("XrootdXeq:", 0, end)
+    redirect = find("Decode xrootd redirects", 0, end)
+    while login >= 0 or redirect >= 0:
+        if redirect < 0 or 0 <= login < redirect:
+            position = login
+        else:
+            position = redirect
+        linestart = rfind("\n", 0, position) + 1
+        lineend = find("\n", position, end) + 1
+        if lineend == 0:
+            lineend = end
+        yield window[linestart:lineend]
+        if 0 <= login < lineend:
+            login = find("XrootdXeq:", lineend, end)
+        if 0 <= redirect < lineend:
+            redirect = find("Decode xrootd redirects", lineend, end)
+
+def XrootdRecordLines(buffer, start, end):
+    '''
+    The lines of buffer[start:end] (which starts a line) holding an
+    xrootd record marker, with their newline
+    '''
+    while start < end:
+        window = buffer[start:min(start + XrootdScanWindowBytes, end)]
+        length = len(window)
+        if start + length < end:
+            # stop the window after its last newline, the next one starts there
+            length = window.rfind("\n") + 1
+            if length == 0:
+                # a line longer than the window, take all of it
+                lineend = buffer.find("\n", start + len(window), end) + 1
+                if lineend == 0:
+                    lineend = end
+                window = buffer[start:lineend]
+                length = len(window)
+        for line in XrootdWindowRecordLines(window, length):
+            yield line
+        start += length
+
+def XrootdBlockRecordLines(infile, length=None):
+    '''
+    The lines holding an xrootd record marker of the next length bytes
+    (all the rest without length, which end a line) of infile, read a
+    block at a time
+    '''
+    carry = ""
+    while length is None or length > 0:
+        size = XrootdScanWindowBytes
+        if length is not None:
+            size = min(size, length)
+        block = infile.read(size)
+        if not block:
+            break
+        if length is not None:
+            length -= len(block)
+        block = carry + block
+        # the partial line after the last newline goes with the next block
+        end = block.rfind("\n") + 1
+        for line in XrootdWindowRecordLines(block, end):
+            yield line
+        carry = block[end:]
+    for line in XrootdWindowRecordLines(carry, len(carry)):
+        yield line
+
+'''
+Compressed xrootd logs.  logrotate compresses the rotated logs, so an
+xrootd.log file ending in .gz, .bz2 or .xz is decompressed by its
+program into a pipe, which is read a block at a time while the program
+goes on decompressing; nothing is written to disk.  A compressed log
+is parsed whole, it cannot be cut into byte ranges.
+'''
+XrootdLogDecompressors = {".gz": "gzip", ".bz2": "bzip2", ".xz": "xz"}
+
+def XrootdLogDecompressor(filename):
+    '''
+    The program decompressing the xrootd log filename, or None when it
+    is not compressed
+    '''
+    return XrootdLogDecompressors.get(os.path.splitext(filename)[1], None)
+
+def OpenXrootdLog(filename):
+    '''
+    Open the xrootd log filename, through a pipe from its decompression
+    program when it is compressed, and return the file and the
+    decompression process (None when it is not compressed)
+    '''
+    decompressor = XrootdLogDecompressor(filename)
+    if not decompressor:
+        return open(filename), None
+    decompression = subprocess.Popen([decompressor, "-dc", filename], stdout=subprocess.PIPE, bufsize=-1)
+    return decompression.stdout, decompression
+
+def CloseXrootdLog(filename, infile, decompression):
+    '''
+    Close an xrootd log opened with OpenXrootdLog
+    '''
+    infile.close()
+    if decompression and decompression.wait() != 0:
+        raise IOError("cannot decompress xrootd log %s" % filename)
+
+def ParseXrootdLogFile(filename, jobs, hostnames, start=0, end=None):
+    '''
+    Add the records of the xrootd log filename (of its byte range start
+    to end, starting a line, unless it is compressed) to the
+    dictionaries, see ParseXrootdLog
+    '''
+    if XrootdLogDecompressor(filename):
+        infile, decompression = OpenXrootdLog(filename)
+        ParseXrootdLog(XrootdBlockRecordLines(infile), jobs, hostnames)
+        CloseXrootdLog(filename, infile, decompression)
+        return
+    infile = open(filename)
+    size = os.fstat(infile.fileno()).st_size
+    if end is None or end > size:
+        end = size
+    if start < end and XrootdLogReader == "blocks":
+        infile.seek(start)
+        ParseXrootdLog(XrootdBlockRecordLines(infile, end - start), jobs, hostnames)
+    elif start < end:
+        buffer = mmap.mmap(infile.fileno(), size, access=mmap.ACCESS_READ)
+        ParseXrootdLog(XrootdRecordLines(buffer, start, end), jobs, hostnames)
+        buffer.close()
+    infile.close()
+
+
+'''
+Parsing the xrootd logs in parallel.  The log files, in the order of
+their modification times (the rotated logs first, the live xrootd.log
+last), are cut into byte ranges of about XrootdLogRangeBytes that end
+at a newline, so that a big log is spread over the workers as well.
+Each range is parsed by a worker process into dictionaries of its own,
+and the partial dictionaries are merged in file and range order.
+Merging a job's fields in that order, a later range's record replacing
+an earlier one and the hostname lists concatenating, gives exactly the
+dictionaries a single process would build parsing the files one after
+another.
+'''
+XrootdLogRangeBytes = 64 * 1024 * 1024
+
+def XrootdLogFilenames(directory):
+    '''
+    The xrootd.log files of directory, oldest first
+    '''
+    filenames = [os.path.join(directory, filename) for filename in os.listdir(directory) if filename.find("xrootd.log") >= 0]
+    return sorted(filenames, key=lambda filename: (os.path.getmtime(filename), filename))
+
+def XrootdLogRanges(filenames, rangebytes):
+    '''
+    The (filename, start, end) byte ranges, each ending at a newline (or
+    at the end of the file), that filenames are parsed in; a compressed
+    file is a single range
+    '''
+    ranges = []
+    for filename in filenames:
+        if XrootdLogDecompressor(filename):
+            ranges.append((filename, 0, None))
+            continue
+        size = os.path.getsize(filename)
+        infile = open(filename)
+        start = 0
+        while start < size:
+            infile.seek(min(start + rangebytes, size))
+            infile.readline()
+            end = min(infile.tell(), size)
+            ranges.append((filename, start, end))
+            start = end
+        infile.close()
+    return ranges
+
+def ParseXrootdLogRange(logrange):
+    '''
+    Parse one byte range of an xrootd log into new dictionaries (run in
+    a worker process)
+    '''
+    filename, start, end = logrange
+    jobs = {}
+    hostnames = {}
+    ParseXrootdLogFile(filename, jobs, hostnames, start, end)
+    return jobs, hostnames
+
+def MergeXrootdLog(jobs, hostnames, partialjobs, partialhostnames):
+    '''
+    Merge the dictionaries of a later log range into jobs and hostnames
+    '''
+    for jobid, partial in partialjobs.iteritems():
+        current = jobs.get(jobid, None)
+        if (not current):
+            jobs[jobid] = partial
+            continue
+        for field in range(4):
+            if partial[field] is not None:
+                current[field] = partial[field]
+    for hostname, partial in partialhostnames.iteritems():
+        current = hostnames.get(hostname, None)
+        if (not current):
+            hostnames[hostname] = partial
+        else:
+            current.extend(partial)
+
+def ParseXrootdLogs(filenames, jobs, hostnames, parsepool=None):
+    '''
+    Parse the xrootd logs filenames (oldest first) into jobs and
+    hostnames, a byte range at a time per process of parsepool, or in
+    this process without one
+    '''
+    if parsepool is None:
+        for filename in filenames:
+            ParseXrootdLogFile(filename, jobs, hostnames)
+        return
+    # imap hands the partial dictionaries back in range order
+    ranges = XrootdLogRanges(filenames, XrootdLogRangeBytes)
+    for partialjobs, partialhostnames in parsepool.imap(ParseXrootdLogRange, ranges):
+        MergeXrootdLog(jobs, hostnames, partialjobs, partialhostnames)
+
+
+def StartXrootdLogParsers(workers):
+    '''
+    Return a pool of worker processes for ParseXrootdLogs, or None for
+    parsing in this process
+    '''
+    if workers > 1:
+        return multiprocessing.Pool(workers)
+    return None
+
+def StopXrootdLogParsers(parsepool):
+    '''
+    Shut down a pool of StartXrootdLogParsers and wait for its processes.
+    After ParseXrootdLogs every range is merged and the workers are idle;
+    on the way out of an error they may still be busy with ranges nobody
+    will merge, so either way they are terminated rather than left to
+    finish.
+    '''
+    if parsepool is None:
+        return
+    parsepool.terminate()
+    parsepool.join()
+
+
+def BenchmarkXrootdLogParser(path, parsepool=None):
+    '''
+    Parse an xrootd log, or the xrootd logs of a directory, into empty
+    dictionaries and print the lines/s
+    '''
+    if os.path.isdir(path):
+        filenames = XrootdLogFilenames(path)
+    else:
+        filenames = [path]
+    lines = 0
+    for filename in filenames:
+        infile, decompression = OpenXrootdLog(filename)
+        for line in infile:
+            lines += 1
+        CloseXrootdLog(filename, infile, decompression)
+    jobs = {}
+    hostnames = {}
+    start = time.time()
+    ParseXrootdLogs(filenames, jobs, hostnames, parsepool)
+    elapsed = time.time() - start
+    print "%d lines, %d jobs in %.2fs: %.0f lines/s" % (lines, len(jobs), elapsed, lines / max(elapsed, 1e-9))
+
+
 def main():    
+    parser = OptionParser()
+    parser.add_option("--strategy", dest="strategy", default="perquery",
+                      type="choice", choices=sorted(QueryGratiaStrategies.keys()),
+                      help="how to query gratia for the statistics: %s (default: %%default)" % ", ".join(sorted(QueryGratiaStrategies.keys())))
+    parser.add_option("--cache-dir", dest="cachedir", default=None,
+                      help="keep the per-window extracts of the columnar strategy in this directory")
+    parser.add_option("--cache-max-mb", dest="cachemaxmb", default=1024, type="int",
+                      help="evict the least recently used extracts beyond this size (default: %default)")
+    parser.add_option("--invalidate-cache", dest="invalidatecache", default=False, action="store_true",
+                      help="drop the cached extract of this report's window before running")
+    parser.add_option("--clear-cache", dest="clearcache", default=False, action="store_true",
+                      help="drop every cached extract before running")
+    parser.add_option("--store-dir", dest="storedir", default=None,
+                      help="local store of the incremental strategy")
+    parser.add_option("--backfill", dest="backfill", default=None, nargs=2, metavar="FIRSTDAY LASTDAY",
+                      help="print the report of every day from FIRSTDAY to LASTDAY (YYYY-MM-DD, included) with one query, and exit")
+    parser.add_option("--parallel", dest="parallel", default=1, type="int",
+                      help="run independent queries in parallel on up to this many connections (default: %default)")
+    parser.add_option("--stream-exit84", dest="streamexit84", default=False, action="store_true",
+                      help="stream the exit 84 overflow jobs through a server-side cursor and match them as they arrive")
+    parser.add_option("--query-log", dest="querylog", default=None,
+                      help="record the time, rows and bytes of every query into this JSON file")
+    parser.add_option("--explain", dest="explain", default=False, action="store_true",
+                      help="with --query-log, also record the EXPLAIN of every query")
+    parser.add_option("--rollup-db", dest="rollupdb", default=None,
+                      help="SQLite file of the daily rollup (rollup strategy and --rollup-report)")
+    parser.add_option("--rollup-report", dest="rollupreport", default=None, nargs=2, metavar="FIRSTDAY LASTDAY",
+                      help="print one report for FIRSTDAY to LASTDAY (YYYY-MM-DD, included) from the rollup, and exit")
+    parser.add_option("--site-groups", dest="sitegroups", default=None,
+                      help="read the sites of the 4-site report from this file ([FourSites] title, patterns)")
+    parser.add_option("--site-cache", dest="sitecache", default=None,
+                      help="keep the HostDescription seen in gratia in this JSON file across runs")
+    parser.add_option("--benchmark", dest="benchmark", default=None, metavar="STRATEGY,STRATEGY...",
+                      help="time these strategies on this report's window, and exit")
+    parser.add_option("--sqlite", dest="sqlite", default=None,
+                      help="read gratia from this SQLite file instead of rcf-gratia.unl.edu (see GenerateSyntheticGratia.py)")
+    parser.add_option("--range-report", dest="rangereport", default=None, nargs=2, metavar="FIRSTDAY LASTDAY",
+                      help="print one report for the window covering the report windows of FIRSTDAY to LASTDAY (YYYY-MM-DD), scanned in slices on --parallel connections, and exit")
+    parser.add_option("--slice-minutes", dest="sliceminutes", default=60, type="int",
+                      help="initial length of the slices of --range-report (default: %default)")
+    parser.add_option("--page-size", dest="pagesize", default=None, type="int",
+                      help="rows per keyset page of the paged strategy; also fetch the exit 84 jobs in pages of this size")
+    parser.add_option("--exit-codes", dest="exitcodes", default=0, type="int", metavar="N",
+                      help="also print the N most frequent exit codes of each population, from one grouped query")
+    parser.add_option("--efficiency-thresholds", dest="efficiencythresholds", default=None, metavar="T,T...",
+                      help="also print the share of jobs and walltime with an efficiency above each threshold (multiples of 0.05 up to 1), and the median efficiency, from the efficiency histogram")
+    parser.add_option("--probes", dest="probes", default=None, metavar="PROBE,PROBE...",
+                      help="print one report per probe (e.g. several glidein factories), all from one grouped query")
+    parser.add_option("--parse-benchmark", dest="parsebenchmark", default=None, metavar="XROOTDLOG",
+                      help="time the parsing of this xrootd log, or of the logs of this directory (see GenerateSyntheticGratia.py), and exit")
+    parser.add_option("--parse-workers", dest="parseworkers", default=1, type="int",
+                      help="parse the xrootd log files in this many processes")
+    parser.add_option("--parse-range-mb", dest="parserangemb", default=64, type="int",
+                      help="with --parse-workers, parse the xrootd logs in ranges of about this many MB [default: %default]")
+    parser.add_option("--log-reader", dest="logreader", default="mapped", choices=["mapped", "blocks"],
+                      help="map the xrootd logs, or read them in blocks: mapped or blocks [default: %default]")
+    (options, args) = parser.parse_args()
+    started = datetime.now()
+    global XrootdLogRangeBytes, XrootdLogReader
+    XrootdLogRangeBytes = options.parserangemb * 1024 * 1024
+    XrootdLogReader = options.logreader
+    if options.parsebenchmark:
+        parsepool = StartXrootdLogParsers(options.parseworkers)
+        try:
+            BenchmarkXrootdLogParser(options.parsebenchmark, parsepool)
+        finally:
+            StopXrootdLogParsers(parsepool)
+        return
+    global QueryLog, QueryLogExplain, GratiaSQLiteFile, KeysetPageSize
+    GratiaSQLiteFile = options.sqlite
+    if options.pagesize:
+        KeysetPageSize = options.pagesize
+    if options.querylog:
+        QueryLog = []
+        QueryLogExplain = options.explain
+    if options.strategy == "incremental" and not options.storedir:
+        parser.error("the incremental strategy needs --store-dir")
+    if (options.strategy == "rollup" or options.rollupreport) and not options.rollupdb:
+        parser.error("the rollup needs --rollup-db")
+    if options.probes and options.parallel > 1:
+        parser.error("--probes runs a single query, without --parallel")
+    efficiencythresholds = []
+    if options.efficiencythresholds:
+        if options.strategy == "perquery" and not options.probes:
+            parser.error("the per-query strategy has no efficiency histogram")
+        try:
+            efficiencythresholds = [float(threshold) for threshold in options.efficiencythresholds.split(",")]
+        except ValueError:
+            parser.error("efficiency thresholds must be numbers")
+        for threshold in efficiencythresholds:
+            if EfficiencyThresholdBin(threshold) is None:
+                parser.error("efficiency threshold %s is not a multiple of 0.05 up to 1" % threshold)
+    if options.benchmark:
+        benchmarkstrategies = options.benchmark.split(",")
+        for strategy in benchmarkstrategies:
+            if strategy not in QueryGratiaStrategies:
+                parser.error("unknown strategy %s" % strategy)
+    global FourSitesTitle, FourSitesPatterns, SiteGroupCacheFile
+    if options.sitegroups:
+        FourSitesTitle, FourSitesPatterns = ReadSiteGroups(options.sitegroups)
+    SiteGroupCacheFile = options.sitecache
+    global JobColumnsCacheDirectory, JobColumnsCacheMaxBytes, IncrementalStoreDirectory, RollupDatabase
+    IncrementalStoreDirectory = options.storedir
+    RollupDatabase = options.rollupdb
+    if options.cachedir:
+        JobColumnsCacheDirectory = options.cachedir
+        JobColumnsCacheMaxBytes = options.cachemaxmb * 1024 * 1024
+        if options.clearcache:
+            InvalidateJobColumnsCache(options.cachedir)
+        elif options.invalidatecache:
+            InvalidateJobColumnsCache(options.cachedir, GlideinProbeName, EarliestEndTime, LatestEndTime)
     # connect the database server rcf-gratia.unl.edu
     db, cursor = ConnectDatabase()
-    # query database gratia, and output statistic results
-    QueryGratia(cursor)
-    # Get all the filenames in the form of xrootd.log
-    # then for each file, build the hash table
-    filenames = os.listdir("/var/log/xrootd")
-    for filename in filenames:
-        if (filename.find("xrootd.log")>=0):
-            buildJobLoginDisconnectionAndSoOnDictionary("/var/log/xrootd/"+filename)
-    # check with xrootd log, and output possible overflow jobs with exit code 84
-    FilterCondorJobs(cursor)
+    if options.backfill:
+        firstday, lastday = [datetime.strptime(day, "%Y-%m-%d").date() for day in options.backfill]
+        Backfill(db, firstday, lastday)
+        db.close()
+        if options.querylog:
+            WriteQueryLog(options.querylog, QueryLog, started)
+        return
+    if options.benchmark:
+        BenchmarkStrategies(cursor, benchmarkstrategies)
+        db.close()
+        if options.querylog:
+            WriteQueryLog(options.querylog, QueryLog, started)
+        return
+    if options.rangereport:
+        firstday, lastday = [datetime.strptime(day, "%Y-%m-%d").date() for day in options.rangereport]
+        RangeReport(firstday, lastday, options.parallel, timedelta(0, options.sliceminutes * 60))
+        db.close()
+        if options.querylog:
+            WriteQueryLog(options.querylog, QueryLog, started)
+        return
+    if options.rollupreport:
+        firstday, lastday = [datetime.strptime(day, "%Y-%m-%d").date() for day in options.rollupreport]
+        RollupReport(cursor, firstday, lastday)
+        db.close()
+        if options.querylog:
+            WriteQueryLog(options.querylog, QueryLog, started)
+        return
+    # fork the parsing processes before any query thread is started
+    parsepool = StartXrootdLogParsers(options.parseworkers)
+    try:
+        if options.probes:
+            # one grouped scan for all the probes, then one report each
+            ReportProbes(cursor, options.probes.split(","), efficiencythresholds, options.exitcodes)
+        elif options.parallel > 1:
+            # run the statistics queries and the exit 84 fetch on pooled
+            # connections while we parse the xrootd logs
+            pool = ConnectionPool(ConnectGratia, options.parallel)
+            executor = QueryExecutor(pool, options.parallel)
+            tasks = QueryGratiaParallelTasks.get(options.strategy, [QueryGratiaStrategies[options.strategy]])
+            fetchoverflowjobs = not (options.streamexit84 or options.pagesize)
+            if fetchoverflowjobs:
+                tasks = tasks + [FetchOverflowJobsExitCode84]
+            executor.run(tasks)
+        else:
+            # query database gratia, and output statistic results
+            statistics = QueryGratia(cursor, options.strategy)
+        # Get all the filenames in the form of xrootd.log
+        # then build the hash tables from them, oldest first
+        filenames = XrootdLogFilenames("/var/log/xrootd")
+        ParseXrootdLogs(filenames, jobLoginDisconnectionAndSoOnDictionary, hostnameJobsDictionary, parsepool)
+    finally:
+        StopXrootdLogParsers(parsepool)
+    if options.parallel > 1:
+        results = executor.wait()
+        pool.close()
+        if fetchoverflowjobs:
+            overflowjobs = results.pop()
+        statistics = NewReportStatistics()
+        for partial in results:
+            MergeReportStatistics(statistics, partial)
+        PrintReport(statistics)
+    if efficiencythresholds and not options.probes:
+        PrintEfficiencyThresholds(statistics, efficiencythresholds)
+    if options.exitcodes > 0 and not options.probes:
+        PrintExitCodeDistribution(QueryExitCodeDistribution(cursor), options.exitcodes)
+    if options.streamexit84:
+        MatchOverflowJobsExitCode84(StreamOverflowJobsExitCode84(db.cursor(MySQLdb.cursors.SSCursor)))
+    elif options.pagesize:
+        MatchOverflowJobsExitCode84(PageOverflowJobsExitCode84(cursor, options.pagesize))
+    elif options.parallel > 1:
+        MatchOverflowJobsExitCode84(overflowjobs)
+    else:
+        # check with xrootd log, and output possible overflow jobs with exit code 84
+        FilterCondorJobs(cursor)
     # disconnect the database
     db.close()
+    if options.querylog:
+        WriteQueryLog(options.querylog, QueryLog, started)
     # output result in the following format
     # for cmssrv32.fnal.gov (a redirection site)
     #   for user /....../CN=Brian (a x509UserProxyVOName)